@@ -3,5 +3,4 @@
 set -e
 set -x
 
-docker run -t -v $PWD:/src -w /src -e SUFFIX=-py2 python:2.7 maintenance/pin-helper.sh
 docker run -t -v $PWD:/src -w /src python:3.7 maintenance/pin-helper.sh
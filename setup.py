@@ -4,12 +4,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """setup module for mar package."""
-from __future__ import absolute_import
-from __future__ import print_function
-
 import io
 import re
-import sys
 from glob import glob
 from os.path import basename
 from os.path import dirname
@@ -25,10 +21,7 @@ requires = [
     'click',
     'construct',
     'cryptography',
-    'six',
 ]
-if sys.version_info[0] == 2:
-    requires.append('backports.lzma')
 
 
 def read(*names, **kwargs):
@@ -65,7 +58,6 @@ setup(
         'Operating System :: POSIX',
         'Operating System :: Microsoft :: Windows',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
@@ -82,6 +74,7 @@ setup(
     keywords=[
         'mozilla', 'mar', 'archive',
     ],
+    python_requires='>=3.7',
     install_requires=requires,
     extras_require={
         # eg:
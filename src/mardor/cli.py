@@ -1,7 +1,5 @@
 #!/usr/bin/env python
 """Utility for managing mar files."""
-from __future__ import print_function
-
 import base64
 import logging
 import os
@@ -14,11 +12,23 @@ import mardor.mozilla
 from mardor.reader import MarReader
 from mardor.signing import format_hash
 from mardor.signing import get_keysize
+from mardor.utils import advise_sequential
 from mardor.writer import MarWriter
 from mardor.writer import add_signature_block
 
 log = logging.getLogger(__name__)
 
+# Public keys available via :mozilla-<name> on the commandline
+_BUILTIN_KEYS = {
+    ('release', 'sha1'): (mardor.mozilla.release1_sha1, mardor.mozilla.release2_sha1),
+    ('release', 'sha384'): (mardor.mozilla.release1_sha384, mardor.mozilla.release2_sha384),
+    ('nightly', 'sha1'): (mardor.mozilla.nightly1_sha1, mardor.mozilla.nightly2_sha1),
+    ('nightly', 'sha384'): (mardor.mozilla.nightly1_sha384, mardor.mozilla.nightly2_sha384),
+    ('dep', 'sha1'): (mardor.mozilla.dep1_sha1, mardor.mozilla.dep2_sha1),
+    ('dep', 'sha384'): (mardor.mozilla.dep1_sha384, mardor.mozilla.dep2_sha384),
+    ('autograph-stage', 'sha384'): (mardor.mozilla.autograph_stage_sha384,),
+}
+
 
 def build_argparser():
     """Build argument parser for the CLI."""
@@ -83,6 +93,7 @@ def build_argparser():
 def do_extract(marfile, destdir, decompress):
     """Extract the MAR file to the destdir."""
     with open(marfile, 'rb') as f:
+        advise_sequential(f)
         with MarReader(f) as m:
             m.extract(str(destdir), decompress=decompress)
 
@@ -99,26 +110,18 @@ def get_keys(keyfiles, signature_type):
         List of public keys as strings
 
     """
-    builtin_keys = {
-        ('release', 'sha1'): [mardor.mozilla.release1_sha1, mardor.mozilla.release2_sha1],
-        ('release', 'sha384'): [mardor.mozilla.release1_sha384, mardor.mozilla.release2_sha384],
-        ('nightly', 'sha1'): [mardor.mozilla.nightly1_sha1, mardor.mozilla.nightly2_sha1],
-        ('nightly', 'sha384'): [mardor.mozilla.nightly1_sha384, mardor.mozilla.nightly2_sha384],
-        ('dep', 'sha1'): [mardor.mozilla.dep1_sha1, mardor.mozilla.dep2_sha1],
-        ('dep', 'sha384'): [mardor.mozilla.dep1_sha384, mardor.mozilla.dep2_sha384],
-        ('autograph-stage', 'sha384'): [mardor.mozilla.autograph_stage_sha384],
-    }
     keys = []
     for keyfile in keyfiles:
         if keyfile.startswith(':mozilla-'):
             name = keyfile.split(':mozilla-')[1]
             try:
-                keys.extend(builtin_keys[name, signature_type])
+                keys.extend(_BUILTIN_KEYS[name, signature_type])
             except KeyError:
                 raise ValueError('Invalid internal key name: {}'
                                  .format(keyfile))
         else:
-            with open(keyfile, 'rb') as f:
+            # Key files are small; skip the buffering layer and read them in one go
+            with open(keyfile, 'rb', buffering=0) as f:
                 key = f.read()
             keys.append(key)
     return keys
@@ -143,7 +146,9 @@ def do_verify(marfile, keyfiles=None):
                         print(e)
                         sys.exit(1)
 
-                    if any(m.verify(key) for key in keys):
+                    # Only hash the file once, no matter how many keys we're checking
+                    hashes = m.calculate_hashes()
+                    if any(m.verify(key, hashes) for key in keys):
                         print("Verification OK")
                         return True
                     else:
@@ -227,7 +232,7 @@ def do_hash(hash_algo, marfile, asn1=False):
 
 def do_add_signature(input_file, output_file, signature_file):
     """Add a signature to the MAR file."""
-    with open(signature_file, 'rb') as f:
+    with open(signature_file, 'rb', buffering=0) as f:
         signature = f.read()
     if len(signature) == 256:
         hash_algo = 'sha1'
@@ -268,7 +273,7 @@ def check_args(parser, args):
 def get_key_from_cmdline(parser, args):
     """Return the signing key and signing algoritm from the commandline."""
     if args.keyfiles:
-        with open(args.keyfiles[0], 'rb') as f:
+        with open(args.keyfiles[0], 'rb', buffering=0) as f:
             signing_key = f.read()
         bits = get_keysize(signing_key)
         if bits == 2048:
@@ -297,10 +302,11 @@ def main(argv=None):
     check_args(parser, args)
 
     if args.extract:
-        marfile = os.path.abspath(args.extract)
+        marfile = args.extract
         if args.chdir:
+            marfile = os.path.abspath(marfile)
             os.chdir(args.chdir)
-        do_extract(marfile, os.getcwd(), args.compression)
+        do_extract(marfile, os.curdir, args.compression)
 
     elif args.verify:
         do_verify(args.verify, args.keyfiles)
@@ -312,10 +318,11 @@ def main(argv=None):
         print("\n".join(do_list(args.list_detailed, detailed=True)))
 
     elif args.create:
-        marfile = os.path.abspath(args.create)
+        marfile = args.create
         signing_key, signing_algorithm = get_key_from_cmdline(parser, args)
 
         if args.chdir:
+            marfile = os.path.abspath(marfile)
             os.chdir(args.chdir)
         do_create(marfile, args.files, args.compression,
                   productversion=args.productversion, channel=args.channel,
@@ -7,23 +7,71 @@ This relies on the construct module for specifying the data structures.
 
 See also https://wiki.mozilla.org/Software_Update:MAR
 """
+import struct
 
 from construct import Array
 from construct import Bytes
 from construct import Computed
 from construct import Const
-from construct import CString
-from construct import GreedyRange
+from construct import Construct
+from construct import Container
 from construct import If
 from construct import Int32ub
 from construct import Int64ub
+from construct import ListContainer
 from construct import Pointer
 from construct import Prefixed
 from construct import Select
+from construct import SizeofError
+from construct import StreamError
 from construct import Struct
 from construct import Tell
-from construct import len_
 from construct import this
+from construct.core import stream_seek
+from construct.core import stream_tell
+from construct.core import stream_write
+
+
+class FastCString(Construct):
+    """A null terminated string.
+
+    This is equivalent to construct's CString, but looks for the null
+    terminator in larger chunks with bytes.find rather than reading one byte
+    at a time.
+    """
+
+    chunk_size = 256
+
+    def __init__(self, encoding):
+        """Initialize a new FastCString.
+
+        Args:
+            encoding (str): encoding of the string, e.g. 'ascii'
+        """
+        super(FastCString, self).__init__()
+        self.encoding = encoding
+
+    def _parse(self, stream, context, path):
+        start = stream_tell(stream, path)
+        data = b''
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                raise StreamError("could not find string terminator", path=path)
+            i = chunk.find(b'\x00')
+            if i >= 0:
+                data += chunk[:i]
+                break
+            data += chunk
+        # Leave the stream positioned just after the terminator
+        stream_seek(stream, start + len(data) + 1, 0, path)
+        return data.decode(self.encoding)
+
+    def _build(self, obj, stream, context, path):
+        data = obj.encode(self.encoding) + b'\x00'
+        stream_write(stream, data, len(data), path)
+        return obj
+
 
 mar_header = "mar_header" / Struct(
     "magic" / Const(b"MAR1"),
@@ -50,18 +98,21 @@ extra_entry = "extra_entry" / Struct(
     "data" / Bytes(this.size - 8),
 )
 
+
+def _productinfo_padding(ctx):
+    """Return the number of padding bytes at the end of a productinfo entry."""
+    # 8 bytes for size/id fields, and an
+    # extra 2 bytes for the null terminator after
+    # channel and productversion
+    return ctx.size - len(ctx.channel) - len(ctx.productversion) - 8 - 2
+
+
 productinfo_entry = "productinto_entry" / Struct(
     "size" / Int32ub,
     "id" / Const(value=1, subcon=Int32ub),
-    "channel" / CString(encoding='ascii'),
-    "productversion" / CString(encoding='ascii'),
-    "padding" / Bytes(
-                this.size - len_(this.channel) - len_(this.productversion) -
-                # 8 bytes for size/id fields, and an
-                # extra 2 bytes for the null terminator after
-                # channel and productversion
-                8 - 2,
-    ),
+    "channel" / FastCString('ascii'),
+    "productversion" / FastCString('ascii'),
+    "padding" / Bytes(_productinfo_padding),
 )
 
 extras_header = "extras_header" / Struct(
@@ -75,11 +126,99 @@ index_entry = "index_entry" / Struct(
     "offset" / Int32ub,
     "size" / Int32ub,
     "flags" / Int32ub,
-    "name" / CString(encoding='ascii'),
+    "name" / FastCString('ascii'),
 )
 
+_index_entry_fields = struct.Struct('>III')
+
+
+class IndexEntry(object):
+    """A single entry of a MAR index, as built up by MarWriter.
+
+    This uses much less memory than a dict or Container, which matters for
+    MAR files with many entries. IndexEntries can build indexes from these as
+    well as from dicts. Fields can also be read with e['name'] etc. for code
+    that expects dicts.
+    """
+
+    __slots__ = ('offset', 'size', 'flags', 'name')
+
+    def __init__(self, offset, size, flags, name):
+        """Initialize a new IndexEntry.
+
+        Args:
+            offset (int): offset of the entry's data in the MAR file
+            size (int): size of the entry's data
+            flags (int): file permissions of the entry
+            name (str): name of the entry
+        """
+        self.offset = offset
+        self.size = size
+        self.flags = flags
+        self.name = name
+
+    def __getitem__(self, key):
+        """Return the field called `key`."""
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        """Return a string representation of this entry."""
+        return 'IndexEntry(offset={!r}, size={!r}, flags={!r}, name={!r})'.format(
+            self.offset, self.size, self.flags, self.name)
+
+
+class IndexEntries(Construct):
+    """A list of index_entry structures running to the end of the stream.
+
+    This is equivalent to GreedyRange(index_entry), but unpacks each entry
+    directly with struct and bytes.find rather than going through construct
+    field by field. Parsing stops at the first incomplete entry.
+    """
+
+    def _parse(self, stream, context, path):
+        start = stream_tell(stream, path)
+        data = stream.read()
+        entries = ListContainer()
+        unpack = _index_entry_fields.unpack_from
+        pos = 0
+        while pos + _index_entry_fields.size < len(data):
+            name_start = pos + _index_entry_fields.size
+            name_end = data.find(b'\x00', name_start)
+            if name_end < 0:
+                break
+            try:
+                name = data[name_start:name_end].decode('ascii')
+            except UnicodeDecodeError:
+                break
+            offset, size, flags = unpack(data, pos)
+            entries.append(Container(offset=offset, size=size, flags=flags, name=name))
+            pos = name_end + 1
+        # Leave any trailing data unconsumed, as GreedyRange does
+        stream_seek(stream, start + pos, 0, path)
+        return entries
+
+    def _build(self, obj, stream, context, path):
+        pack = _index_entry_fields.pack
+        parts = []
+        for e in obj:
+            if isinstance(e, IndexEntry):
+                header, name = pack(e.offset, e.size, e.flags), e.name
+            else:
+                header, name = pack(e['offset'], e['size'], e['flags']), e['name']
+            parts.append(header + name.encode('ascii') + b'\x00')
+        data = b''.join(parts)
+        stream_write(stream, data, len(data), path)
+        return obj
+
+    def _sizeof(self, context, path):
+        raise SizeofError(path=path)
+
+
 index_header = "index_header" / Struct(
-    "entries" / Prefixed(Int32ub, GreedyRange(index_entry)),
+    "entries" / Prefixed(Int32ub, IndexEntries()),
 )
 
 
@@ -110,6 +249,7 @@ def _has_extras(ctx):
 
     It does this by looking at where file data starts in the file. If this
     starts immediately after the signature data, then no additional sections are present.
+    MAR files without a signature section never have additional sections.
 
     Args:
         ctx (context): construct parsing context
@@ -119,10 +259,11 @@ def _has_extras(ctx):
         False otherwise
 
     """
-    if not ctx.index.entries:
+    # _has_sigs has already checked the index and data offset for us
+    if not ctx.signatures:
         return False
 
-    return ctx.data_offset > 8 and ctx.data_offset > (ctx.signatures.offset_end + 8)
+    return ctx.data_offset > (ctx.signatures.offset_end + 8)
 
 
 def _data_offset(ctx):
@@ -133,10 +274,30 @@ def _data_offset(ctx):
         return max(ctx.index.entries[0].offset, 8)
 
 
+def _compiled(subcon):
+    """Return a compiled version of `subcon`, which parses much faster.
+
+    The original, interpreted, construct is returned if this version of
+    construct can't compile it: versions before 2.9 have no compile method,
+    and some 2.9 releases raise NotImplementedError for fields they can't
+    compile. Any other error is raised.
+    """
+    try:
+        compile_ = subcon.compile
+    except AttributeError:
+        return subcon
+    try:
+        return compile_()
+    except NotImplementedError:
+        return subcon
+
+
+# The top level structure uses functions for its conditions, so can't be
+# compiled itself. Its parts can be.
 mar = "mar" / Struct(
-    "header" / mar_header,
+    "header" / _compiled(mar_header),
 
-    "index" / Pointer(this.header.index_offset, index_header),
+    "index" / Pointer(this.header.index_offset, _compiled(index_header)),
 
     # Helper attributes to assist with navigating the file
     "data_offset" / Computed(_data_offset),
@@ -149,6 +310,6 @@ mar = "mar" / Struct(
     # These sections will not be present for older MAR files
     # that don't have signature / extra sections
     # Only add them if the earliest entry offset is greater than 8
-    "signatures" / If(_has_sigs, sigs_header),
-    "additional" / If(_has_extras, extras_header),
+    "signatures" / If(_has_sigs, _compiled(sigs_header)),
+    "additional" / If(_has_extras, _compiled(extras_header)),
 )
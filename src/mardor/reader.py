@@ -8,21 +8,42 @@ verify MAR files.
 """
 
 import os
+from multiprocessing import cpu_count
 
 from mardor.format import mar
 from mardor.signing import get_signature_data
+from mardor.signing import hash_blocks
 from mardor.signing import make_hasher
 from mardor.signing import verify_signature
+from mardor.utils import _join_curdir
 from mardor.utils import auto_decompress_stream
 from mardor.utils import bz2_decompress_stream
 from mardor.utils import file_iter
 from mardor.utils import guess_compression
+from mardor.utils import make_safejoin
+from mardor.utils import map_file
 from mardor.utils import mkdir
-from mardor.utils import safejoin
+from mardor.utils import run_threaded
+from mardor.utils import sendfile
 from mardor.utils import takeexactly
-from mardor.utils import write_to_file
+from mardor.utils import view_iter
+from mardor.utils import write_to_fd
 from mardor.utils import xz_decompress_stream
 
+# Names of the hash algorithms used by each signature algorithm id
+_hash_algos = {1: 'sha1', 2: 'sha384'}
+
+
+def _make_extract_join(destdir):
+    """Return a function that safely joins entry names to `destdir`.
+
+    Paths under the current directory are kept relative, which saves looking
+    up its absolute path.
+    """
+    if os.path.normpath(destdir) == os.curdir:
+        return _join_curdir
+    return make_safejoin(destdir)
+
 
 class MarReader(object):
     """Support for reading, extracting, and verifying MAR files.
@@ -38,6 +59,10 @@ class MarReader(object):
         Note:
             Files should always be opened in binary mode.
 
+            Real files are memory mapped for reading. Use the MarReader as a
+            context manager so that the map is released when you're done;
+            otherwise it stays open until the MarReader is garbage collected.
+
         Args:
             fileobj (file object): A file-like object open in read mode where
                 the MAR data will be read from. This object must also be
@@ -47,13 +72,25 @@ class MarReader(object):
 
         self.mardata = mar.parse_stream(self.fileobj)
 
+        # Read file contents directly out of a memory map where possible
+        self._view = map_file(self.fileobj)
+
     def __enter__(self):
         """Support the context manager protocol."""
         return self
 
     def __exit__(self, type_, value, tb):
         """Support the context manager protocol."""
-        pass
+        if self._view is not None:
+            view, self._view = self._view, None
+            mm = view.obj
+            view.release()
+            try:
+                mm.close()
+            except BufferError:
+                # An unfinished extract_entry generator is still using the
+                # map; it will be closed once that is garbage collected
+                pass
 
     @property
     def compression_type(self):
@@ -64,9 +101,7 @@ class MarReader(object):
 
         """
         best_compression = None
-        for e in self.mardata.index.entries:
-            self.fileobj.seek(e.offset)
-            magic = self.fileobj.read(10)
+        for magic in self._entry_magics():
             compression = guess_compression(magic)
             if compression == 'xz':
                 best_compression = 'xz'
@@ -75,6 +110,20 @@ class MarReader(object):
                 best_compression = 'bz2'
         return best_compression
 
+    def _entry_magics(self, size=10):
+        """Yield the first `size` bytes of each entry, in file order.
+
+        Entries are visited in order of their offset, so that without a
+        memory map this is a single forward pass over the file rather than
+        seeking back and forth.
+        """
+        for e in sorted(self.mardata.index.entries, key=lambda e: e.offset):
+            if self._view is not None:
+                yield self._view[e.offset:e.offset + size]
+            else:
+                self.fileobj.seek(e.offset)
+                yield self.fileobj.read(size)
+
     @property
     def signature_type(self):
         """Return the signature type used in this MAR.
@@ -106,11 +155,26 @@ class MarReader(object):
                 Defaults to 'auto'
 
         Yields:
-            Blocks of data for `e`
+            Blocks of data for `e`, as bytes
 
         """
-        self.fileobj.seek(e.offset)
-        stream = file_iter(self.fileobj)
+        for block in self._entry_blocks(e, decompress):
+            # Don't hand out views of our memory map
+            if isinstance(block, memoryview):
+                block = bytes(block)
+            yield block
+
+    def _entry_blocks(self, e, decompress):
+        """Yield blocks of data for `e`, like extract_entry.
+
+        Blocks may be memoryview slices of the memory mapped file, which are
+        only valid while this reader is open.
+        """
+        if self._view is not None:
+            stream = view_iter(self._view, e.offset)
+        else:
+            self.fileobj.seek(e.offset)
+            stream = file_iter(self.fileobj)
         stream = takeexactly(stream, e.size)
         if decompress == 'auto':
             stream = auto_decompress_stream(stream)
@@ -126,7 +190,7 @@ class MarReader(object):
         for block in stream:
             yield block
 
-    def extract(self, destdir, decompress='auto'):
+    def extract(self, destdir, decompress='auto', workers=None):
         """Extract the entire MAR file into a directory.
 
         Args:
@@ -136,15 +200,55 @@ class MarReader(object):
             decompress (obj, optional): Controls whether files are decompressed
                 when extracted. Must be one of 'auto' or None. Defaults to
                 'auto'.
+            workers (int, optional): Number of threads to decompress entries
+                with. Defaults to the number of CPUs. Entries are only
+                decompressed in parallel if the MAR file can be memory mapped.
         """
+        # Entries with the same name are written one after the other, in index
+        # order, so that the last one wins, as it would if they were all
+        # extracted serially
+        join = _make_extract_join(destdir)
+        paths = {}
         for e in self.mardata.index.entries:
-            name = e.name
-            entry_path = safejoin(destdir, name)
-            entry_dir = os.path.dirname(entry_path)
+            paths.setdefault(join(e.name), []).append(e)
+        # Extract entries in the order they appear in the file, so that reading
+        # them is mostly a single forward pass
+        tasks = sorted(paths.items(), key=lambda item: item[1][0].offset)
+
+        # Many entries usually share a directory; only create each one once.
+        # Entries extracted to the top of the current directory have no
+        # dirname.
+        for entry_dir in sorted(set(os.path.dirname(p) or os.curdir for p in paths)):
             mkdir(entry_dir)
+
+        def extract_path(item):
+            entry_path, entries = item
+            for e in entries:
+                extract_one(e, entry_path)
+
+        def extract_one(e, entry_path):
             with open(entry_path, 'wb') as f:
-                write_to_file(self.extract_entry(e, decompress), f)
-                os.chmod(entry_path, e.flags)
+                if decompress is None:
+                    # Copy the data as-is; let the kernel do it if it can
+                    self.fileobj.seek(e.offset)
+                    sendfile(self.fileobj, f, e.size)
+                else:
+                    # Nothing has been buffered in `f`, so it's safe to write
+                    # to its file descriptor directly
+                    write_to_fd(self._entry_blocks(e, decompress), f.fileno())
+                if hasattr(os, 'fchmod'):
+                    os.fchmod(f.fileno(), e.flags)
+                else:  # pragma: no cover
+                    os.chmod(entry_path, e.flags)
+
+        # Decompression releases the GIL, so entries can be extracted in
+        # parallel. This is only safe when reading out of the memory map;
+        # otherwise the threads would be fighting over the file position.
+        if decompress is None or self._view is None:
+            workers = 1
+        elif workers is None:
+            workers = cpu_count()
+        run_threaded(extract_path, tasks, workers)
 
     def _get_signature_errors(self):
         errors = []
@@ -193,11 +297,18 @@ class MarReader(object):
 
         return errors if errors else None
 
-    def verify(self, verify_key):
+    def verify(self, verify_key, hashes=None):
         """Verify that this MAR file has a valid signature.
 
         Args:
             verify_key (str): PEM formatted public key
+            hashes (list, optional): list of (algorithm_id, hash) tuples as
+                returned by .calculate_hashes(). Passing these in avoids
+                hashing the MAR file again when checking several keys.
+                There must be one hash for each of this MAR file's
+                signatures, in the same order and with the same algorithm
+                ids; otherwise verification fails. Defaults to calculating
+                the hashes from the MAR file.
 
         Returns:
             True if the MAR file's signature matches its contents
@@ -208,21 +319,24 @@ class MarReader(object):
             # This MAR file can't be verified since it has no signatures
             return False
 
-        hashers = []
-        for sig in self.mardata.signatures.sigs:
-            hashers.append((sig.algorithm_id, sig.signature, make_hasher(sig.algorithm_id)))
-
-        assert len(hashers) == len(self.mardata.signatures.sigs)
-
-        for block in get_signature_data(self.fileobj,
-                                        self.mardata.signatures.filesize):
-            [h.update(block) for (_, _, h) in hashers]
+        sigs = self.mardata.signatures.sigs
+        if hashes is None:
+            hashes = self.calculate_hashes()
 
-        for algo_id, sig, h in hashers:
-            if not verify_signature(verify_key, sig, h.finalize(), h.algorithm.name):
+        # There must be a hash for each signature, in the same order. Hashes
+        # of another MAR file, or for other algorithms, can't verify this one.
+        if len(hashes) != len(sigs):
+            return False
+        for sig, (algo_id, h) in zip(sigs, hashes):
+            if algo_id != sig.algorithm_id:
                 return False
-        else:
-            return True
+            try:
+                hash_algo = _hash_algos[sig.algorithm_id]
+            except KeyError:
+                raise ValueError("Unsupported signing algorithm: %s" % sig.algorithm_id)
+            if not verify_signature(verify_key, sig.signature, h, hash_algo):
+                return False
+        return True
 
     @property
     def productinfo(self):
@@ -253,7 +367,10 @@ class MarReader(object):
             h = make_hasher(s.algorithm_id)
             hashers.append((s.algorithm_id, h))
 
-        for block in get_signature_data(self.fileobj, self.mardata.signatures.filesize):
-            [h.update(block) for (_, h) in hashers]
+        # Hash through the map this reader already has, rather than mapping
+        # the file a second time
+        blocks = get_signature_data(self.fileobj, self.mardata.signatures.filesize,
+                                    signatures=self.mardata.signatures, view=self._view)
+        hash_blocks([h for (_, h) in hashers], blocks)
 
-        return [(algo_id, h.finalize()) for (algo_id, h) in hashers]
+        return [(algo_id, h.digest()) for (algo_id, h) in hashers]
@@ -2,8 +2,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """Signing, verification and key support for MAR files."""
-from construct import Int32ub
-from construct import Int64ub
+import hashlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from construct import Container
+from construct import ListContainer
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
@@ -12,29 +17,53 @@ from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric import utils
 
-from mardor.format import mar
-from mardor.format import sigs_header
+from mardor.utils import DEFAULT_BLOCK_SIZE
 from mardor.utils import file_iter
+from mardor.utils import map_file
+from mardor.utils import prefetch
+
+# Signatures are made over hashes we've already calculated. These are
+# stateless, so they're shared between calls.
+_prehashed = {
+    'sha1': utils.Prehashed(hashes.SHA1()),
+    'sha384': utils.Prehashed(hashes.SHA384()),
+}
+_padding = padding.PKCS1v15()
+
+# default_backend() is memoized by cryptography, but there's no need to look
+# it up every time a key is loaded
+_backend = default_backend()
 
-_hash_algorithms = {
-    'sha1': hashes.SHA1(),
-    'sha384': hashes.SHA384(),
+# Placeholder signatures of the right size for each algorithm id. bytes are
+# immutable, so the same objects can be handed out every time.
+_dummy_signatures = {
+    1: b'\x00' * 256,
+    2: b'\x00' * 512,
 }
 
+# magic and index_offset fields of the MAR header
+_mar_header_fields = struct.Struct('>4sI')
+# filesize and count fields of the signatures header
+_sigs_header_fields = struct.Struct('>QI')
+# algorithm_id and size fields of each signature entry
+_sig_entry_fields = struct.Struct('>II')
+# index size, or the offset field of the first index entry
+_uint32_field = struct.Struct('>I')
+
 
 def get_publickey(keydata):
     """Load the public key from a PEM encoded string."""
     try:
         key = serialization.load_pem_public_key(
             keydata,
-            backend=default_backend(),
+            backend=_backend,
         )
         return key
     except ValueError:
         key = serialization.load_pem_private_key(
             keydata,
             password=None,
-            backend=default_backend(),
+            backend=_backend,
         )
         key = key.public_key()
         return key
@@ -45,27 +74,108 @@ def get_privatekey(keydata):
     key = serialization.load_pem_private_key(
         keydata,
         password=None,
-        backend=default_backend(),
+        backend=_backend,
     )
     return key
 
 
+# Signing or verifying several MAR files with the same key shouldn't parse it
+# each time
+_publickey_cache = lru_cache(maxsize=32)(get_publickey)
+_privatekey_cache = lru_cache(maxsize=32)(get_privatekey)
+
+
+def _cached_publickey(keydata):
+    # The cache needs hashable keys
+    if isinstance(keydata, (bytearray, memoryview)):
+        keydata = bytes(keydata)
+    return _publickey_cache(keydata)
+
+
+def _cached_privatekey(keydata):
+    if isinstance(keydata, (bytearray, memoryview)):
+        keydata = bytes(keydata)
+    return _privatekey_cache(keydata)
+
+
 def get_keysize(keydata):
     """Return the key size of a public key."""
-    key = get_publickey(keydata)
+    key = _cached_publickey(keydata)
     return key.key_size
 
 
-def get_signature_data(fileobj, filesize):
+def _read_unpack(fileobj, fields):
+    data = fileobj.read(fields.size)
+    if len(data) != fields.size:
+        raise IOError("Unexpected end of MAR file")
+    return fields.unpack(data)
+
+
+def read_signatures_header(fileobj):
+    """Read the signatures header of a MAR file, without the signatures.
+
+    This reads only the handful of fields needed to locate the signed data,
+    rather than parsing the entire MAR file with :obj:`mardor.format.mar`.
+
+    Args:
+        fileobj (file-like object): file-like object to read the MAR data from
+
+    Returns:
+        None if the MAR file has no signature section. Otherwise a Container
+        with `filesize`, `count`, `sigs` and `offset_end` attributes,
+        matching those of :obj:`mardor.format.sigs_header`. Each element of
+        `sigs` has `algorithm_id` and `size` attributes, but no `signature`.
+
+    """
+    fileobj.seek(0)
+    magic, index_offset = _read_unpack(fileobj, _mar_header_fields)
+    if magic != b'MAR1':
+        raise IOError("Not a MAR file")
+
+    # Old style MAR files have their file data immediately after the MAR
+    # header. See also mardor.format._has_sigs
+    fileobj.seek(index_offset)
+    index_size, = _read_unpack(fileobj, _uint32_field)
+    # An index entry is at least its three integer fields and a terminator
+    if index_size <= 12:
+        return None
+    first_offset, = _read_unpack(fileobj, _uint32_field)
+    if first_offset <= 8:
+        return None
+
+    fileobj.seek(8)
+    filesize, count = _read_unpack(fileobj, _sigs_header_fields)
+    sigs = ListContainer()
+    offset = 8 + _sigs_header_fields.size
+    for _ in range(count):
+        algorithm_id, size = _read_unpack(fileobj, _sig_entry_fields)
+        sigs.append(Container(algorithm_id=algorithm_id, size=size))
+        offset += _sig_entry_fields.size + size
+        fileobj.seek(offset)
+    return Container(filesize=filesize, count=count, sigs=sigs, offset_end=offset)
+
+
+def get_signature_data(fileobj, filesize, block_size=DEFAULT_BLOCK_SIZE, signatures=None, view=None):
     """Read data from MAR file that is required for MAR signatures.
 
     Args:
         fileboj (file-like object): file-like object to read the MAR data from
         filesize (int): the total size of the file
+        block_size (int): maximum size of the blocks of file data to yield
+            if `fileobj` can't be memory mapped. Defaults to
+            DEFAULT_BLOCK_SIZE. If the file can be mapped, or is a BytesIO,
+            all of the file data is yielded as a single memoryview, so that
+            hashing it happens entirely in C.
+        signatures (:obj:`mardor.format.sigs_header`, optional): the already
+            parsed signatures header of this MAR file. If not provided, it
+            is read with read_signatures_header.
+        view (memoryview, optional): an existing view of all of the data in
+            `fileobj`, e.g. as returned by map_file. If not provided,
+            `fileobj` is memory mapped here where possible.
 
     Yields:
-        blocks of bytes representing the data required to generate or validate
-        signatures.
+        blocks of bytes-like objects representing the data required to
+        generate or validate signatures.
 
     """
     # Read everything except the signature entries
@@ -73,44 +183,87 @@ def get_signature_data(fileobj, filesize):
     # of the additional section to the end of the file. The signature
     # algorithm id and size fields are also covered.
 
-    fileobj.seek(0)
-    marfile = mar.parse_stream(fileobj)
-    if not marfile.signatures:
+    if signatures is None:
+        signatures = read_signatures_header(fileobj)
+    if not signatures:
         raise IOError("Can't generate signature data for file without signature blocks")
 
-    # MAR header
+    # The MAR header, signatures header, and the algorithm id and size of each
+    # signature entry are small, so they're hashed as a single block
     fileobj.seek(0)
-    block = fileobj.read(8)
-    yield block
-
-    # Signatures header
-    sigs = sigs_header.parse_stream(fileobj)
-
-    sig_types = [(sig.algorithm_id, sig.size) for sig in sigs.sigs]
-
-    block = Int64ub.build(filesize) + Int32ub.build(sigs.count)
-    yield block
-
-    # Signature algorithm id and size per entry
-    for algorithm_id, size in sig_types:
-        block = Int32ub.build(algorithm_id) + Int32ub.build(size)
-        yield block
-
-    # Everything else in the file is covered
-    for block in file_iter(fileobj):
+    preamble = [fileobj.read(8), _sigs_header_fields.pack(filesize, signatures.count)]
+    for sig in signatures.sigs:
+        preamble.append(_sig_entry_fields.pack(sig.algorithm_id, sig.size))
+    yield b''.join(preamble)
+
+    # Everything else in the file is covered. The seek above has flushed
+    # anything still buffered in `fileobj`, so the map sees all of the data.
+    if view is None:
+        view = map_file(fileobj)
+    if view is None and hasattr(fileobj, 'getbuffer'):
+        # In-memory files (BytesIO) can be hashed in place as well
+        view = fileobj.getbuffer()
+    if view is not None:
+        yield view[signatures.offset_end:]
+        return
+
+    # Otherwise read the next blocks from disk while the current ones are
+    # being hashed
+    fileobj.seek(signatures.offset_end)
+    for block in prefetch(file_iter(fileobj, block_size)):
         yield block
 
 
 def make_hasher(algorithm_id):
-    """Create a hashing object for the given signing algorithm."""
+    """Create a hashing object for the given signing algorithm.
+
+    Returns:
+        a hashlib hash object. Its .name is suitable for passing to
+        sign_hash and verify_signature.
+
+    """
     if algorithm_id == 1:
-        return hashes.Hash(hashes.SHA1(), default_backend())
+        return hashlib.sha1()
     elif algorithm_id == 2:
-        return hashes.Hash(hashes.SHA384(), default_backend())
+        return hashlib.sha384()
     else:
         raise ValueError("Unsupported signing algorithm: %s" % algorithm_id)
 
 
+def hash_blocks(hashers, blocks):
+    """Update each of `hashers` with every block from `blocks`.
+
+    When there is more than one hasher, the extra hashers are updated from
+    worker threads while the first is updated in the calling thread.
+    hashlib releases the GIL while hashing, so e.g. the SHA-1 and SHA-384
+    hashes of a file are calculated in parallel. Every hasher is finished
+    with a block before the next one is requested.
+
+    Args:
+        hashers (list): hash objects, as returned by make_hasher
+        blocks (iterable): blocks of data to hash
+
+    Raises:
+        any exception raised while updating one of the hashers
+
+    """
+    if not hashers:
+        return
+
+    first, rest = hashers[0], hashers[1:]
+    if not rest:
+        for block in blocks:
+            first.update(block)
+        return
+
+    with ThreadPoolExecutor(len(rest)) as executor:
+        for block in blocks:
+            futures = [executor.submit(h.update, block) for h in rest]
+            first.update(block)
+            for f in futures:
+                f.result()
+
+
 def sign_hash(private_key, hash, hash_algo):
     """Sign the given hash with the given private key.
 
@@ -123,11 +276,10 @@ def sign_hash(private_key, hash, hash_algo):
         byte string representing the signature
 
     """
-    hash_algo = _hash_algorithms[hash_algo]
-    return get_privatekey(private_key).sign(
+    return _cached_privatekey(private_key).sign(
         hash,
-        padding.PKCS1v15(),
-        utils.Prehashed(hash_algo),
+        _padding,
+        _prehashed[hash_algo],
     )
 
 
@@ -144,13 +296,12 @@ def verify_signature(public_key, signature, hash, hash_algo):
         True if the signature is valid, False otherwise
 
     """
-    hash_algo = _hash_algorithms[hash_algo]
     try:
-        return get_publickey(public_key).verify(
+        return _cached_publickey(public_key).verify(
             signature,
             hash,
-            padding.PKCS1v15(),
-            utils.Prehashed(hash_algo),
+            _padding,
+            _prehashed[hash_algo],
         ) is None
     except InvalidSignature:
         return False
@@ -169,7 +320,7 @@ def make_rsa_keypair(bits):
     private_key = rsa.generate_private_key(
         public_exponent=65537,
         key_size=bits,
-        backend=default_backend(),
+        backend=_backend,
     )
     private_pem = private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
@@ -194,11 +345,9 @@ def make_dummy_signature(algorithm_id):
         a byte string
 
     """
-    if algorithm_id == 1:
-        return b'\x00' * 256
-    elif algorithm_id == 2:
-        return b'\x00' * 512
-    else:
+    try:
+        return _dummy_signatures[algorithm_id]
+    except KeyError:
         raise ValueError("Invalid algorithm id: %s" % algorithm_id)
 
 
@@ -3,16 +3,24 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """Utilities for reading/writing MAR files."""
 import bz2
+import io
+import lzma
+import mmap
 import os
+import queue
+import stat
+import threading
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from functools import partial
 from itertools import chain
 
-import six
-
-if six.PY2:
-    from backports import lzma
-else:
-    import lzma
+# Default size of the blocks of data read from files. Larger blocks mean
+# fewer trips through the interpreter when hashing or compressing data, with
+# diminishing returns beyond a few MiB.
+DEFAULT_BLOCK_SIZE = 4 * 1024**2
 
 
 def mkdir(path):
@@ -40,51 +48,333 @@ def mkdir(path):
         raise
 
 
-def file_iter(f):
+def file_iter(f, block_size=DEFAULT_BLOCK_SIZE):
     """Yield blocks of data from file object `f`.
 
     Args:
         f (file-like object): file-like object that must suport .read(n)
+        block_size (int): maximum size of each block. Defaults to
+            DEFAULT_BLOCK_SIZE.
+
+    Returns:
+        an iterator over blocks of data from `f`
+
+    """
+    # Calling iter() with a sentinel keeps the loop in C
+    return iter(partial(f.read, block_size), b'')
+
+
+def readinto_iter(f, block_size=1024**2):
+    """Yield blocks of data from file object `f`, reusing a single buffer.
+
+    This avoids allocating a new bytes object for every block. Each block
+    is a memoryview into the same buffer, so it is only valid until the next
+    block is requested. Consumers that hold on to blocks, e.g. by passing
+    them to other threads, should use file_iter instead.
+
+    Args:
+        f (file-like object): file-like object to read from. Falls back to
+            file_iter if it doesn't support .readinto(buf)
+        block_size (int): maximum size of each block. Defaults to 1 MiB;
+            the buffer is allocated up front, so this is kept smaller than
+            DEFAULT_BLOCK_SIZE to keep adding many small files cheap.
 
     Yields:
-        blocks of data from `f`
+        memoryview blocks of data from `f`
 
     """
-    for block in iter(partial(f.read, 1024**2), b''):
-        yield block
+    if not hasattr(f, 'readinto'):
+        for block in file_iter(f, block_size):
+            yield block
+        return
+
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    n = f.readinto(buf)
+    while n:
+        yield view[:n]
+        n = f.readinto(buf)
+
+
+def real_fileno(fileobj):
+    """Return the file descriptor holding exactly the data of `fileobj`.
+
+    Only io.FileIO objects, and buffered file objects directly on top of
+    them (as returned by open()), qualify. Other file-like objects may have
+    a fileno() for an underlying file whose contents differ from what they
+    read and write, e.g. gzip.GzipFile.
+
+    Args:
+        fileobj (file-like object): file object to check
+
+    Returns:
+        the file descriptor, or None if there isn't one that can be used
+        directly
+
+    """
+    raw = fileobj
+    if isinstance(fileobj, io.BufferedIOBase):
+        raw = getattr(fileobj, 'raw', None)
+    if not isinstance(raw, io.FileIO):
+        return None
+    try:
+        return raw.fileno()
+    except ValueError:
+        # The file has been closed
+        return None
+
+
+def map_file(fileobj):
+    """Memory map the contents of `fileobj`.
+
+    Args:
+        fileobj (file-like object): file object to map. Must be open for
+            reading.
+
+    Returns:
+        A read-only memoryview of the file's contents, or None if the file
+        can't be mapped (e.g. it's empty, or isn't a real file; see
+        real_fileno).
+
+    """
+    fd = real_fileno(fileobj)
+    if fd is None:
+        return None
+    try:
+        return memoryview(mmap.mmap(fd, 0, access=mmap.ACCESS_READ))
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def view_iter(view, offset=0, block_size=DEFAULT_BLOCK_SIZE):
+    """Yield consecutive slices of `view`.
+
+    Args:
+        view (memoryview): data to slice up
+        offset (int): where to start in `view`. Defaults to 0.
+        block_size (int): maximum size of each slice. Defaults to
+            DEFAULT_BLOCK_SIZE.
+
+    Yields:
+        memoryview slices of `view` from `offset` to the end
+
+    """
+    for i in range(offset, len(view), block_size):
+        yield view[i:i + block_size]
+
+
+def advise_sequential(fileobj):
+    """Tell the OS that `fileobj` will be read sequentially.
+
+    This lets the kernel read ahead more aggressively. Nothing is done on
+    platforms without posix_fadvise, or if `fileobj` isn't a real file.
+
+    Args:
+        fileobj (file-like object): file object to advise on
+
+    """
+    if not hasattr(os, 'posix_fadvise'):  # pragma: no cover
+        return
+    try:
+        os.posix_fadvise(fileobj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+
+def preallocate(fileobj, size):
+    """Reserve disk space for the first `size` bytes of `fileobj`.
+
+    Allocating the space up front lets the filesystem lay the file out in
+    fewer, larger extents than if it grows a write at a time. The file is
+    extended to `size` bytes if it's shorter.
+
+    Args:
+        fileobj (file-like object): file object to allocate space for
+        size (int): number of bytes to allocate
+
+    Returns:
+        True if the space was allocated, False if this isn't supported on
+        this platform or for `fileobj`.
+
+    """
+    if not hasattr(os, 'posix_fallocate'):  # pragma: no cover
+        return False
+    try:
+        os.posix_fallocate(fileobj.fileno(), 0, size)
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
+
+
+def prefetch(iterable, depth=4):
+    """Yield items from `iterable`, reading ahead from a background thread.
+
+    This lets slow producers (e.g. reading from disk) overlap with the work
+    being done on each item by the consumer. At most `depth` items are read
+    ahead. If the consumer stops early, the background thread is stopped
+    before this generator exits, so `iterable` is never accessed
+    concurrently with the caller.
+
+    Args:
+        iterable (iterable): iterable to read items from
+        depth (int): maximum number of items to read ahead. Defaults to 4.
+
+    Yields:
+        items from `iterable`
+
+    """
+    q = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+    errors = []
+
+    def producer():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                q.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            q.put(done)
+
+    t = threading.Thread(target=producer)
+    t.daemon = True
+    t.start()
+    try:
+        for item in iter(q.get, done):
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        # Unblock the producer if it's waiting on a full queue
+        while t.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except queue.Empty:  # pragma: no cover
+                pass
+
+
+def run_threaded(func, items, workers):
+    """Call `func` on each of `items`, spread across a pool of threads.
+
+    Items are handed out to the threads in order. If any call raises an
+    exception, no further items are started and the first exception (in the
+    order of `items`) is re-raised once the running calls have finished.
+
+    Args:
+        func (callable): function to call with each item
+        items (iterable): items to process
+        workers (int): maximum number of threads to use. If this is 1 or less,
+            everything is done in the calling thread.
+
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            func(item)
+        return
+
+    with ThreadPoolExecutor(min(workers, len(items))) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        _, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for f in not_done:
+            f.cancel()
+    for f in futures:
+        if not f.cancelled():
+            f.result()
+
+
+def threaded_imap(func, iterable, workers):
+    """Yield func(item) for each item of `iterable`, using a pool of threads.
+
+    Results are yielded in the same order as `iterable`. At most 2 * `workers`
+    items are in progress at any time, so memory use stays bounded even for
+    long iterables. This is only worthwhile if `func` releases the GIL, as
+    e.g. the bz2 and lzma compressors do.
+
+    Args:
+        func (callable): function to call with each item
+        iterable (iterable): items to process
+        workers (int): number of threads to use
+
+    Yields:
+        the result of func(item) for each item in `iterable`
+
+    """
+    pending = deque()
+    with ThreadPoolExecutor(workers) as executor:
+        try:
+            for item in iterable:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Drop any work that hasn't been started
+            for f in pending:
+                f.cancel()
+
+
+def rechunk(src, size):
+    """Regroup blocks of data from `src` into blocks of exactly `size` bytes.
+
+    Args:
+        src (iterable): iterable that yields bytes-like blocks of data
+        size (int): size of the blocks to yield
+
+    Yields:
+        blocks of `size` bytes. The last block may be shorter. At least one
+        block is always yielded, even if `src` is empty.
+
+    """
+    buf = bytearray()
+    yielded = False
+    for block in src:
+        buf += block
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+            yielded = True
+    if buf or not yielded:
+        yield bytes(buf)
 
 
 def takeexactly(iterable, size):
     """Yield blocks from `iterable` until exactly len(size) have been returned.
 
     Args:
-        iterable (iterable): Any iterable that yields sliceable objects that
-                             have length.
+        iterable (iterable): Any iterable that yields bytes-like objects
         size (int): How much data to consume
 
     Yields:
         blocks from `iterable` such that
-        sum(len(block) for block in takeexactly(iterable, size)) == size
+        sum(len(block) for block in takeexactly(iterable, size)) == size.
+        If a block has to be cut short, a memoryview of it is yielded rather
+        than a copy.
 
     Raises:
         ValueError if there is less than `size` data in `iterable`
 
     """
-    total = 0
+    remaining = size
     for block in iterable:
-        n = min(len(block), size - total)
-        block = block[:n]
-        if block:
-            yield block
-        total += len(block)
-        if total >= size:
+        n = len(block)
+        if n >= remaining:
+            if n > remaining:
+                block = memoryview(block)[:remaining]
+            if remaining:
+                yield block
+            remaining = 0
             break
-    if total < size:
-        raise ValueError('not enough data (yielded {} of {})')
-
-    # sanity check; this should never happen
-    if total != size:  # pragma: no cover
-        raise ValueError('yielded too much data')
+        if n:
+            yield block
+        remaining -= n
+    if remaining:
+        raise ValueError('not enough data (yielded {} of {})'.format(size - remaining, size))
 
 
 def write_to_file(src, dst):
@@ -100,26 +390,227 @@ def write_to_file(src, dst):
 
     """
     n = 0
+    write = dst.write
     for block in src:
-        dst.write(block)
+        write(block)
         n += len(block)
     return n
 
 
-def bz2_compress_stream(src, level=9):
+def _write_all(fd, blocks):
+    """Write all of `blocks` to `fd`, coping with partial writes."""
+    views = [memoryview(b) for b in blocks]
+    written = 0
+    while views:
+        if hasattr(os, 'writev'):
+            n = os.writev(fd, views)
+        else:  # pragma: no cover
+            n = os.write(fd, views[0])
+        written += n
+        # Drop whatever has been written
+        while views and n >= len(views[0]):
+            n -= len(views.pop(0))
+        if n:  # pragma: no cover; partial writes are rare on regular files
+            views[0] = views[0][n:]
+    return written
+
+
+def pwrite(fd, data, offset):
+    """Write all of `data` to the file descriptor `fd` at `offset`.
+
+    This doesn't use or change the file position of `fd`.
+
+    Args:
+        fd (int): file descriptor open for writing
+        data (bytes-like object): data to write
+        offset (int): position in the file to write `data` to
+
+    Returns:
+        number of bytes written
+
+    """
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+    return len(data)
+
+
+def write_to_fd(src, fd, batch=16):
+    """Write data from `src` into the file descriptor `fd`.
+
+    Blocks are written with os.writev where available, so that up to `batch`
+    blocks go to the kernel in a single system call, without passing
+    through a buffered file object.
+
+    Args:
+        src (iterable): iterable that yields blocks of data to write
+        fd (int): file descriptor open for writing
+        batch (int): maximum number of blocks to write at once. Defaults to
+            16.
+
+    Returns:
+        number of bytes written to `fd`
+
+    """
+    n = 0
+    pending = []
+    for block in src:
+        pending.append(block)
+        if len(pending) >= batch:
+            n += _write_all(fd, pending)
+            pending = []
+    if pending:
+        n += _write_all(fd, pending)
+    return n
+
+
+def _copy_blocks(src, dst, size):
+    """Copy `size` bytes (or everything) from `src` to `dst` in Python."""
+    blocks = readinto_iter(src)
+    if size is not None:
+        blocks = takeexactly(blocks, size)
+    return write_to_file(blocks, dst)
+
+
+def _copy_file_range(src_fd, dst_fd, src_offset, dst_offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+
+
+def _sendfile(src_fd, dst_fd, src_offset, dst_offset, count):
+    # sendfile writes at the current position of dst_fd, which is dst_offset
+    # once the file object has been flushed
+    return os.sendfile(dst_fd, src_fd, src_offset, count)
+
+
+# In-kernel copy functions, in order of preference. copy_file_range lets the
+# filesystem share or clone the data rather than copying it, where supported.
+_kernel_copiers = [copier for (name, copier) in (
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _sendfile),
+) if hasattr(os, name)]
+
+
+def _kernel_copy_with(copier, src_fd, dst_fd, src_offset, dst_offset, size):
+    """Copy `size` bytes with `copier`; return None if it can't be used.
+
+    Raises:
+        IOError if the copy stops part way through
+
+    """
+    n = 0
+    while n < size:
+        try:
+            sent = copier(src_fd, dst_fd, src_offset + n, dst_offset + n, size - n)
+        except OSError:
+            # Some platforms only support sendfile to sockets, and
+            # copy_file_range may not support copying between filesystems.
+            # Once data has been copied we can't fall back any more.
+            if n:  # pragma: no cover
+                raise
+            return None
+        if not sent:
+            # Some filesystems don't support copy_file_range, and just copy
+            # nothing. Otherwise, the file was truncated underneath us.
+            if n:
+                raise IOError('copy stopped after {} of {} bytes'.format(n, size))
+            return None
+        n += sent
+    return n
+
+
+def _kernel_copy(src_fd, dst_fd, src_offset, dst_offset, size):
+    """Copy `size` bytes within the kernel; return None if that isn't possible."""
+    for copier in _kernel_copiers:
+        n = _kernel_copy_with(copier, src_fd, dst_fd, src_offset, dst_offset, size)
+        if n is not None:
+            return n
+    return None
+
+
+def sendfile(src, dst, size=None):
+    """Copy data from `src` into `dst`.
+
+    When both file objects are real files (see real_fileno), `src` is a
+    regular file, and os.copy_file_range or os.sendfile is available, the
+    copy is done by the kernel without passing the data through Python.
+    Otherwise this falls back to write_to_file.
+
+    Args:
+        src (file-like object): file-like object to read from. Data is copied
+            from its current position.
+        dst (file-like object): file-like object to write to
+        size (int, optional): number of bytes to copy. Defaults to copying
+            everything up to the end of `src`.
+
+    Returns:
+        number of bytes written to `dst`
+
+    Raises:
+        ValueError if there is less than `size` data in `src`
+
+    """
+    src_fd = real_fileno(src)
+    dst_fd = real_fileno(dst)
+    if src_fd is None or dst_fd is None or not _kernel_copiers:
+        return _copy_blocks(src, dst, size)
+    st = os.fstat(src_fd)
+    if not stat.S_ISREG(st.st_mode):
+        return _copy_blocks(src, dst, size)
+
+    # Flush any buffered data so that the kernel writes to the right place
+    dst.flush()
+    src_offset = src.tell()
+    dst_offset = dst.tell()
+    available = st.st_size - src_offset
+    if size is None:
+        size = available
+    elif size > available:
+        raise ValueError('not enough data (wanted {} of {})'.format(size, available))
+    n = _kernel_copy(src_fd, dst_fd, src_offset, dst_offset, size)
+    if n is None:
+        return _copy_blocks(src, dst, size)
+
+    # Sync up the file objects with where the kernel left things
+    src.seek(src_offset + n)
+    dst.seek(dst_offset + n)
+    return n
+
+
+def bz2_compress_stream(src, level=9, workers=1):
     """Compress data from `src`.
 
     Args:
-        src (iterable): iterable that yields blocks of data to compress
+        src (iterable): iterable that yields bytes-like blocks of data to
+            compress. Each block is consumed before the next one is
+            requested, so blocks may share a buffer, as from readinto_iter.
         level (int): compression level (1-9) default is 9
+        workers (int): number of threads to compress with. Defaults to 1.
+            With more than one worker, the data is split up into chunks of
+            one bzip2 block (`level` * 100kB), and each is compressed as a
+            separate stream. The result is a valid multi-stream bzip2 file
+            (as produced by pbzip2), which bz2_decompress_stream can read.
+            Note that the Firefox updater only reads the first stream of
+            each entry, so this must not be used for MAR files that will be
+            applied by Firefox.
 
     Yields:
         blocks of compressed data
 
     """
+    if workers > 1:
+        chunks = rechunk(src, level * 100000)
+        for block in threaded_imap(partial(bz2.compress, compresslevel=level), chunks, workers):
+            yield block
+        return
+
     compressor = bz2.BZ2Compressor(level)
+    compress = compressor.compress
     for block in src:
-        encoded = compressor.compress(block)
+        # The compressor buffers up a whole bzip2 block before returning
+        # anything, so most calls return nothing; don't pass those on
+        encoded = compress(block)
         if encoded:
             yield encoded
     yield compressor.flush()
@@ -137,16 +628,33 @@ def bz2_decompress_stream(src):
     """
     dec = bz2.BZ2Decompressor()
     for block in src:
-        decoded = dec.decompress(block)
-        if decoded:
-            yield decoded
-
-
-def xz_compress_stream(src, bcj=None):
+        while block:
+            try:
+                decoded = dec.decompress(block)
+            except EOFError:
+                # The previous stream ended exactly at the end of a block;
+                # what follows is another stream
+                dec = bz2.BZ2Decompressor()
+                continue
+            if decoded:
+                yield decoded
+            # Multi-stream files have another stream after this one
+            block = dec.unused_data
+            if block:
+                dec = bz2.BZ2Decompressor()
+
+
+def xz_compress_stream(src, bcj=None, preset=None):
     """Compress data from `src`.
 
     Args:
-        src (iterable): iterable that yields blocks of data to compress
+        src (iterable): iterable that yields bytes-like blocks of data to
+            compress. Each block is consumed before the next one is
+            requested, so blocks may share a buffer, as from readinto_iter.
+        bcj (str): One of 'x86' or None.
+        preset (int): LZMA2 compression preset (0-9, optionally combined
+            with lzma.PRESET_EXTREME). Lower presets are much faster at the
+            cost of compression ratio. Defaults to lzma.PRESET_DEFAULT.
 
     Yields:
         blocks of compressed data
@@ -157,14 +665,15 @@ def xz_compress_stream(src, bcj=None):
         filters.append({"id": lzma.FILTER_X86})
     filters.extend([
             {"id": lzma.FILTER_LZMA2,
-             "preset": lzma.PRESET_DEFAULT},
+             "preset": lzma.PRESET_DEFAULT if preset is None else preset},
         ])
     compressor = lzma.LZMACompressor(
         check=lzma.CHECK_CRC64,
         filters=filters,
     )
+    compress = compressor.compress
     for block in src:
-        encoded = compressor.compress(block)
+        encoded = compress(block)
         if encoded:
             yield encoded
     yield compressor.flush()
@@ -182,31 +691,47 @@ def xz_decompress_stream(src):
     """
     dec = lzma.LZMADecompressor()
     for block in src:
-        decoded = dec.decompress(block)
-        if decoded:
-            yield decoded
-
-    if dec.unused_data:  # pragma: nocover; can't figure out how to test this
-        raise IOError('Read unused data at end of compressed stream')
+        while block:
+            try:
+                decoded = dec.decompress(block)
+            except EOFError:
+                # The previous stream ended exactly at the end of a block;
+                # what follows is another stream
+                dec = lzma.LZMADecompressor()
+                continue
+            if decoded:
+                yield decoded
+            # Concatenated xz files have another stream after this one
+            block = dec.unused_data
+            if block:
+                dec = lzma.LZMADecompressor()
 
 
 def guess_compression(block):
     """Return the compression type of the data.
 
     Args:
-        block (bytes): block of data to identify
+        block (bytes-like object): block of data to identify
 
     Returns:
         One of None, 'bz2', or 'xz'
 
     """
-    if block.startswith(b'BZh'):
+    # Slices of memoryviews compare equal to bytes directly, so there's no
+    # need to copy the start of the block
+    if block[:3] == b'BZh':
         return 'bz2'
-    elif block.startswith(b'\xfd7zXZ\x00'):
+    elif block[:6] == b'\xfd7zXZ\x00':
         return 'xz'
     return None
 
 
+_decompressors = {
+    'bz2': bz2_decompress_stream,
+    'xz': xz_decompress_stream,
+}
+
+
 def auto_decompress_stream(src):
     """Decompress data from `src` if required.
 
@@ -222,30 +747,63 @@ def auto_decompress_stream(src):
 
     """
     block = next(src)
-    compression = guess_compression(block)
-    if compression == 'bz2':
-        src = bz2_decompress_stream(chain([block], src))
-    elif compression == 'xz':
-        src = xz_decompress_stream(chain([block], src))
+    decompress = _decompressors.get(guess_compression(block))
+    if decompress is None:
+        # Uncompressed data is passed through without another generator
+        yield block
+        yield from src
     else:
-        src = chain([block], src)
+        yield from decompress(chain([block], src))
 
-    for block in src:
-        yield block
+
+def _is_inside(path, dirname):
+    """Return True if the normalized absolute `path` is under `dirname`."""
+    if path == dirname:
+        return True
+    # dirname already ends with a separator if it's a root directory
+    if not dirname.endswith(os.sep):
+        dirname += os.sep
+    return path.startswith(dirname)
 
 
 def path_is_inside(path, dirname):
     """Return True if path is under dirname."""
-    path = os.path.abspath(path)
-    dirname = os.path.abspath(dirname)
-    while len(path) >= len(dirname):
-        if path == dirname:
-            return True
-        newpath = os.path.dirname(path)
-        if newpath == path:
-            return False
-        path = newpath
-    return False
+    return _is_inside(os.path.abspath(path), os.path.abspath(dirname))
+
+
+def _join_curdir(*elements):
+    """Safely join `elements` to the current directory, as a relative path."""
+    path = os.path.normpath(os.path.join(os.curdir, *elements))
+    if (os.path.isabs(path) or os.path.splitdrive(path)[0] or
+            path == os.pardir or path.startswith(os.pardir + os.sep)):
+        raise ValueError('target path is outside of the base path')
+    return path
+
+
+def make_safejoin(base):
+    """Return a function that safely joins paths to `base`.
+
+    This is equivalent to `functools.partial(safejoin, base)`, but only
+    resolves the absolute path of `base` once, which is cheaper when joining
+    many paths to the same base.
+
+    Args:
+        base (str): base path
+
+    Returns:
+        a function taking path elements, as for safejoin
+
+    """
+    # TODO: do we really want to be absolute here?
+    base = os.path.abspath(base)
+
+    def join(*elements):
+        path = os.path.normpath(os.path.join(base, *elements))
+        if not _is_inside(path, base):
+            raise ValueError('target path is outside of the base path')
+        return path
+
+    return join
 
 
 def safejoin(base, *elements):
@@ -262,13 +820,7 @@ def safejoin(base, *elements):
         elements joined to base
 
     """
-    # TODO: do we really want to be absolute here?
-    base = os.path.abspath(base)
-    path = os.path.join(base, *elements)
-    path = os.path.normpath(path)
-    if not path_is_inside(path, base):
-        raise ValueError('target path is outside of the base path')
-    return path
+    return make_safejoin(base)(*elements)
 
 
 def filesize(fileobj):
@@ -5,25 +5,148 @@
 
 This module provides the MarWriter class which is used to write MAR files.
 """
+import io
 import os
+import stat
+import struct
+from multiprocessing import cpu_count
 
-import six
+from construct import Container
+from construct import ListContainer
 
+from mardor.format import IndexEntry
 from mardor.format import extras_header
 from mardor.format import index_header
 from mardor.format import mar
-from mardor.format import mar_header
-from mardor.format import sigs_header
 from mardor.signing import get_signature_data
+from mardor.signing import hash_blocks
 from mardor.signing import make_dummy_signature
 from mardor.signing import make_hasher
 from mardor.signing import sign_hash
+from mardor.utils import advise_sequential
 from mardor.utils import bz2_compress_stream
-from mardor.utils import file_iter
-from mardor.utils import takeexactly
+from mardor.utils import preallocate
+from mardor.utils import pwrite
+from mardor.utils import readinto_iter
+from mardor.utils import sendfile
+from mardor.utils import threaded_imap
 from mardor.utils import write_to_file
 from mardor.utils import xz_compress_stream
 
+# The fixed layout headers are packed directly, rather than going through
+# construct. These must match mar_header and sigs_header in mardor.format.
+_MAR_MAGIC = b'MAR1'
+# magic and index_offset fields of the MAR header
+_mar_header_fields = struct.Struct('>4sI')
+# filesize field of the signatures header
+_filesize_field = struct.Struct('>Q')
+# filesize and count fields of the signatures header
+_sigs_header_fields = struct.Struct('>QI')
+# algorithm_id and size fields of each signature entry
+_sig_entry_fields = struct.Struct('>II')
+# a signatures header with a single signature, up to the signature itself
+_single_sig_header_fields = struct.Struct('>QIII')
+
+# MAR header with an empty index offset, to be filled in by write_header
+_header_placeholder = _mar_header_fields.pack(_MAR_MAGIC, 0)
+
+
+def _buffered(fileobj, buffer_size=1024**2):
+    """Return a buffered file object writing to the same file as `fileobj`.
+
+    MarWriter makes many small writes for headers and index entries. If
+    `fileobj` is unbuffered (e.g. opened with buffering=0), each of those
+    would be a separate system call.
+
+    Args:
+        fileobj (file-like object): file object to buffer
+        buffer_size (int): size of the buffer
+
+    Returns:
+        `fileobj` itself if it is already buffered, or isn't a real file.
+        Otherwise a new buffered file object for its file descriptor. This
+        doesn't own the file descriptor, so `fileobj` still needs to be
+        closed by the caller.
+
+    """
+    if not isinstance(fileobj, io.RawIOBase):
+        return fileobj
+    try:
+        raw = io.FileIO(fileobj.fileno(), fileobj.mode, closefd=False)
+    except (AttributeError, OSError, ValueError):
+        return fileobj
+    if raw.readable():
+        return io.BufferedRandom(raw, buffer_size)
+    return io.BufferedWriter(raw, buffer_size)
+
+
+def _pwrite_fd(fileobj):
+    """Return the file descriptor to use os.pwrite with, or None."""
+    if not hasattr(os, 'pwrite'):  # pragma: no cover
+        return None
+    try:
+        return fileobj.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _walk_files(path):
+    """Yield (path, stat result) for all files under directory `path`.
+
+    Files are visited in the same order as with os.walk, but the stat results
+    cached by os.scandir are used, so each file is only stat'ed once. Like
+    os.walk, symlinks to directories aren't followed. The stat result is None
+    for files that can't be stat'ed, e.g. broken symlinks.
+    """
+    dirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    dirs.append(entry.path)
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                st = None
+            yield entry.path, st
+    for d in dirs:
+        yield from _walk_files(d)
+
+
+def _compress_stream(stream, compress, bcj=None):
+    """Return `stream` compressed with `compress`.
+
+    Args:
+        stream (iterable): yields blocks of data
+        compress (str): One of 'xz', 'bz2', or None.
+        bcj (str): If compress is 'xz', one of 'x86' or None.
+    """
+    if compress == 'bz2':
+        return bz2_compress_stream(stream)
+    elif compress == 'xz':
+        return xz_compress_stream(stream, bcj)
+    elif compress is None:
+        return stream
+    else:
+        raise ValueError('Unsupported compression type: {}'.format(compress))
+
+
+def _read_compressed(item):
+    """Read and compress a file.
+
+    Args:
+        item (tuple): (path, flags, compress, bcj)
+
+    Returns:
+        (path, flags, blocks), where blocks is a list of the compressed data
+
+    """
+    path, flags, compress, bcj = item
+    with open(path, 'rb') as f:
+        advise_sequential(f)
+        return path, flags, list(_compress_stream(readinto_iter(f), compress, bcj))
+
 
 class MarWriter(object):
     """Class for writing MAR files.
@@ -37,6 +160,7 @@ class MarWriter(object):
                  productversion=None, channel=None,
                  signing_key=None,
                  signing_algorithm=None,
+                 preallocate_size=None,
                  ):
         """Initialize a new MarWriter object.
 
@@ -54,16 +178,28 @@ class MarWriter(object):
                 productversion and channel must be specified together
             signing_key (str): PEM encoded private key used for signing
             signing_algorithm (str): one of None, 'sha1', 'sha384'
+            preallocate_size (int, optional): expected size of the MAR file.
+                If given, this much disk space is allocated up front, where
+                supported, which reduces fragmentation of large files. The
+                file is truncated to its real size by finish().
         """
-        self.fileobj = fileobj
         if signing_algorithm and (fileobj.mode not in ('w+b', 'wb+', 'rb+', 'r+b')):
             raise ValueError('fileobj must be opened in w+b mode when signing is enabled; mode is {}'.format(fileobj.mode))
-        self.data_fileobj = fileobj
+        self.fileobj = _buffered(fileobj)
+        self.data_fileobj = self.fileobj
+        # Whether we've added our own buffer in front of `fileobj`
+        self._buffered = self.fileobj is not fileobj
+        self._fd = _pwrite_fd(self.fileobj)
         self.entries = []
         self.signature_offset = 8
         self.additional_offset = None
+        # The layout of the signatures last written by write_signatures
+        self._signatures = None
         self.last_offset = 8
         self.filesize = 0
+        # Where we last left self.fileobj, or None if we don't know. This
+        # saves seeking to where we already are.
+        self._pos = None
         if (productversion or channel) and not (productversion and channel):
             raise ValueError('productversion and channel must be specified'
                              ' together')
@@ -82,7 +218,12 @@ class MarWriter(object):
         if self.use_old_format and self.signing_key:
             raise ValueError("productversion and channel must be specified when signing_key is")
 
-        self.write_header()
+        self._preallocated = bool(preallocate_size) and preallocate(self.fileobj, preallocate_size)
+
+        # The index offset isn't known until finish() writes the real header;
+        # until then just reserve its space
+        self._seek(0)
+        self._write(_header_placeholder)
         if not self.use_old_format:
             fake_sigs = self.dummy_signatures()
             self.write_signatures(fake_sigs)
@@ -114,7 +255,34 @@ class MarWriter(object):
         self.finish()
         self.flush()
 
-    def add(self, path, compress=None, bcj=None):
+    def _seek(self, offset):
+        """Move self.fileobj to `offset`, unless it's already there."""
+        if self._pos != offset:
+            self.fileobj.seek(offset)
+            self._pos = offset
+
+    def _write(self, data):
+        """Write `data` to self.fileobj at its current position."""
+        self.fileobj.write(data)
+        self._pos += len(data)
+
+    def _write_at(self, offset, data):
+        """Write `data` to self.fileobj at `offset`.
+
+        Writes that follow on from the previous one are simply appended.
+        Others, like going back to update the headers, are made with
+        os.pwrite where possible, so there's no need to seek there and back.
+        """
+        if self._pos == offset or self._fd is None:
+            self._seek(offset)
+            self._write(data)
+            return
+        # Anything buffered has to be written first, so it doesn't overwrite
+        # this. Flushing also drops any read-ahead that this would make stale.
+        self.fileobj.flush()
+        pwrite(self._fd, data, offset)
+
+    def add(self, path, compress=None, bcj=None, workers=None):
         """Add `path` to the MAR file.
 
         If `path` is a file, it will be added directly.
@@ -126,25 +294,45 @@ class MarWriter(object):
                 file
             compress (str): One of 'xz', 'bz2', or None. Defaults to None.
             bcj (str): If compress is 'xz', one of 'x86' or None.
+            workers (int, optional): Number of threads to compress the files
+                in a directory with. Defaults to the number of CPUs.
         """
         if os.path.isdir(path):
-            self.add_dir(path, compress, bcj)
+            self.add_dir(path, compress, bcj, workers)
         else:
             self.add_file(path, compress, bcj)
 
-    def add_dir(self, path, compress, bcj=None):
+    def add_dir(self, path, compress, bcj=None, workers=None):
         """Add all files under directory `path` to the MAR file.
 
         Args:
             path (str): path to directory to add to this MAR file
             compress (str): One of 'xz', 'bz2', or None.
             bcj (str): If compress is 'xz', one of 'x86' or None.
+            workers (int, optional): Number of threads to compress files
+                with. Defaults to the number of CPUs. Files are still added to
+                the MAR file in order, one at a time. Up to 2 * `workers`
+                whole compressed files are held in memory while doing so.
         """
         if not os.path.isdir(path):
             raise ValueError('{} is not a directory'.format(path))
-        for root, dirs, files in os.walk(path):
-            for f in files:
-                self.add_file(os.path.join(root, f), compress, bcj)
+
+        if workers is None:
+            workers = cpu_count()
+        if compress is None or workers <= 1:
+            for file_path, st in _walk_files(path):
+                self._add_file(file_path, st, compress, bcj)
+            return
+
+        # The compressors release the GIL, so several files can be compressed
+        # at once. Only the writes to the MAR file have to happen in order.
+        def items():
+            for file_path, st in _walk_files(path):
+                self._check_file(file_path, st)
+                yield file_path, st.st_mode & 0o777, compress, bcj
+
+        for file_path, flags, blocks in threaded_imap(_read_compressed, items(), workers):
+            self.add_stream(blocks, file_path, None, flags)
 
     def add_fileobj(self, fileobj, path, compress, flags=None, bcj=None):
         """Add the contents of a file object to the MAR file.
@@ -156,8 +344,20 @@ class MarWriter(object):
             bcj (str): If compress is 'xz', one of 'x86' or None.
             flags (int): permission of this file in the MAR file. Defaults to the permissions of `path`
         """
-        f = file_iter(fileobj)
-        flags = flags or os.stat(path) & 0o777
+        if flags is None:
+            flags = os.stat(path).st_mode & 0o777
+        if compress is None:
+            # No need to go through Python for uncompressed data
+            self._seek(self.last_offset)
+            # If the copy fails part way through, we don't know where we are
+            self._pos = None
+            size = sendfile(fileobj, self.data_fileobj)
+            self._pos = self.last_offset + size
+            self._add_entry(path, size, flags)
+            return
+        # The compressors copy each block before the next one is read, so
+        # it's safe to reuse the read buffer
+        f = readinto_iter(fileobj)
         return self.add_stream(f, path, compress, flags, bcj)
 
     def add_stream(self, stream, path, compress, flags, bcj=None):
@@ -170,32 +370,31 @@ class MarWriter(object):
             bcj (str): If compress is 'xz', one of 'x86' or None.
             flags (int): permission of this file in the MAR file
         """
-        self.data_fileobj.seek(self.last_offset)
-
-        if compress == 'bz2':
-            stream = bz2_compress_stream(stream)
-        elif compress == 'xz':
-            stream = xz_compress_stream(stream, bcj)
-        elif compress is None:
-            pass
-        else:
-            raise ValueError('Unsupported compression type: {}'.format(compress))
+        self._seek(self.last_offset)
+        stream = _compress_stream(stream, compress, bcj)
 
+        self._pos = None
         size = write_to_file(stream, self.data_fileobj)
+        self._pos = self.last_offset + size
+        self._add_entry(path, size, flags)
+
+    def _add_entry(self, path, size, flags):
+        """Add an entry to the MAR index for data that has already been written.
 
+        The data is expected to start at the current end of the data section.
+
+        Args:
+            path (str): name of this file in the MAR file
+            size (int): number of bytes of data written for this file
+            flags (int): permission of this file in the MAR file
+        """
         # On Windows, convert \ to /
         # very difficult to mock this out for coverage on linux
         if os.sep == '\\':  # pragma: no cover
             path = path.replace('\\', '/')
 
-        e = dict(
-            name=six.u(path),
-            offset=self.last_offset,
-            size=size,
-            flags=flags,
-        )
-        self.entries.append(e)
-        self.last_offset += e['size']
+        self.entries.append(IndexEntry(self.last_offset, size, flags, path))
+        self.last_offset += size
 
     def add_file(self, path, compress, bcj=None):
         """Add a single file to the MAR file.
@@ -205,13 +404,32 @@ class MarWriter(object):
             compress (str): One of 'xz', 'bz2', or None.
             bcj (str): If compress is 'xz', one of 'x86' or None.
         """
-        if not os.path.isfile(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        self._add_file(path, st, compress, bcj)
+
+    @staticmethod
+    def _check_file(path, st):
+        """Raise ValueError unless `st` is the stat result of a regular file."""
+        if st is None or not stat.S_ISREG(st.st_mode):
             raise ValueError('{} is not a file'.format(path))
-        self.fileobj.seek(self.last_offset)
 
+    def _add_file(self, path, st, compress, bcj=None):
+        """Add a single file to the MAR file, given its stat result.
+
+        Args:
+            path (str): path to a file to add to this MAR file.
+            st (os.stat_result): stat result for `path`, or None if it
+                couldn't be found.
+            compress (str): One of 'xz', 'bz2', or None.
+            bcj (str): If compress is 'xz', one of 'x86' or None.
+        """
+        self._check_file(path, st)
         with open(path, 'rb') as f:
-            flags = os.stat(path).st_mode & 0o777
-            self.add_fileobj(f, path, compress, flags, bcj)
+            advise_sequential(f)
+            self.add_fileobj(f, path, compress, st.st_mode & 0o777, bcj)
 
     def write_header(self):
         """Write the MAR header to the file.
@@ -219,9 +437,8 @@ class MarWriter(object):
         The MAR header includes the MAR magic bytes as well as the offset to
         where the index data can be found.
         """
-        self.fileobj.seek(0)
-        header = mar_header.build(dict(index_offset=self.last_offset))
-        self.fileobj.write(header)
+        header = _mar_header_fields.pack(_MAR_MAGIC, self.last_offset)
+        self._write_at(0, header)
 
     def dummy_signatures(self):
         """Create a dummy signature.
@@ -251,12 +468,18 @@ class MarWriter(object):
             return []
 
         algo_id = {'sha1': 1, 'sha384': 2}[self.signing_algorithm]
-        hashers = [(algo_id, make_hasher(algo_id))]
-        for block in get_signature_data(self.fileobj, self.filesize):
-            [h.update(block) for (_, h) in hashers]
-
-        signatures = [(algo_id, sign_hash(self.signing_key, h.finalize(), h.algorithm.name)) for (algo_id, h) in hashers]
-        return signatures
+        # We only ever write a single signature
+        h = make_hasher(algo_id)
+        # The signed data starts with the MAR header and the file size, which
+        # aren't known until everything else has been written. So the hashes
+        # can't be calculated as the data is written, and have to be
+        # calculated from the finished file instead. We do at least know
+        # where the signatures are, without reading them back.
+        # Reading the signature data moves the file position around
+        self._pos = None
+        hash_blocks([h], get_signature_data(self.fileobj, self.filesize, signatures=self._signatures))
+
+        return [(algo_id, sign_hash(self.signing_key, h.digest(), h.name))]
 
     def write_signatures(self, signatures):
         """Write signature data to the MAR file.
@@ -266,23 +489,32 @@ class MarWriter(object):
                 (algorithm_id, signature_data)
 
         """
-        self.fileobj.seek(self.signature_offset)
-        sig_entries = [dict(algorithm_id=id_,
-                            size=len(sig),
-                            signature=sig)
-                       for (id_, sig) in signatures]
-
-        sigs = sigs_header.build(dict(
-            filesize=self.filesize,
-            count=len(signatures),
-            sigs=sig_entries,
-        ))
-        self.fileobj.write(sigs)
+        self._write_at(self.signature_offset, self._build_signatures(signatures))
+
+    def _build_signatures(self, signatures):
+        """Build the signatures header, and record its layout.
+
+        Args:
+            signatures (list): list of signature tuples of the form
+                (algorithm_id, signature_data)
+
+        Returns:
+            the signatures header as bytes
+
+        """
+        parts = [_sigs_header_fields.pack(self.filesize, len(signatures))]
+        for (id_, sig) in signatures:
+            parts.append(_sig_entry_fields.pack(id_, len(sig)))
+            parts.append(sig)
+        sigs = b''.join(parts)
         signatures_len = len(sigs)
         self.additional_offset = self.signature_offset + signatures_len
-        # sanity check; this should never happen
-        if not self.additional_offset == self.fileobj.tell():  # pragma: no cover
-            raise IOError('ended up at unexpected offset')
+        self._signatures = Container(
+            count=len(signatures),
+            sigs=ListContainer(Container(algorithm_id=id_, size=len(sig)) for (id_, sig) in signatures),
+            offset_end=self.additional_offset,
+        )
+        return sigs
 
     def write_additional(self, productversion, channel):
         """Write the additional information to the MAR header.
@@ -292,26 +524,24 @@ class MarWriter(object):
             channel (str): channel string
 
         """
-        self.fileobj.seek(self.additional_offset)
         extras = extras_header.build(dict(
             count=1,
             sections=[dict(
-                channel=six.u(channel),
-                productversion=six.u(productversion),
+                channel=channel,
+                productversion=productversion,
                 size=len(channel) + len(productversion) + 2 + 8,
                 padding=b'',
             )],
         ))
 
-        self.fileobj.write(extras)
-        self.last_offset = self.fileobj.tell()
+        self._write_at(self.additional_offset, extras)
+        self.last_offset = self.additional_offset + len(extras)
 
     def write_index(self):
         """Write the index of all our files to the MAR file."""
-        self.fileobj.seek(self.last_offset)
         index = index_header.build(dict(entries=self.entries))
-        self.fileobj.write(index)
-        self.filesize = self.fileobj.tell()
+        self._write_at(self.last_offset, index)
+        self.filesize = self.last_offset + len(index)
 
     def finish(self):
         """Finalize the MAR file.
@@ -319,16 +549,36 @@ class MarWriter(object):
         The MAR header, index and signatures need to be updated once we've
         finished adding all the files.
         """
-        # Update the last_offset in the mar header
-        self.write_header()
-        # Write out the index of contents
+        # Write out the index of contents. This follows on from the file
+        # data, so it's just appended to what's still buffered.
         self.write_index()
-
-        if not self.use_old_format:
-            # Refresh the signature
+        if self._preallocated:
+            # Drop any space we reserved but didn't use. This has to happen
+            # before hashing, which covers everything to the end of the file.
+            self.fileobj.truncate(self.filesize)
+
+        # Update the last_offset in the mar header, and refresh the
+        # signatures. The writes to the start of the file flush the buffered
+        # data and index in one go, rather than flushing the data first, and
+        # the index later on.
+        if self.use_old_format:
+            self.write_header()
+        elif not self.signing_algorithm:
+            # The signatures header directly follows the MAR header, so
+            # without anything to sign they're written together
+            header = _mar_header_fields.pack(_MAR_MAGIC, self.last_offset)
+            self._write_at(0, header + self._build_signatures([]))
+        else:
+            # The MAR header is covered by the signature, so it has to be
+            # written before the signature can be calculated
+            self.write_header()
             sigs = self.calculate_signatures()
             self.write_signatures(sigs)
 
+        # Callers using an unbuffered file expect it to be complete now
+        if self._buffered:
+            self.flush()
+
 
 def add_signature_block(src_fileobj, dest_fileobj, signing_algorithm, signature=None):
     """Add a signature block to marfile, a MarReader object.
@@ -348,25 +598,13 @@ def add_signature_block(src_fileobj, dest_fileobj, signing_algorithm, signature=
     src_fileobj.seek(0)
     mardata = mar.parse_stream(src_fileobj)
 
-    # Header
-    header = mardata.header
-    dest_fileobj.write(mar_header.build(header))
+    # Header; the index offset will be fixed up later
+    dest_fileobj.write(_header_placeholder)
 
-    # Signature block
-    sig = dict(algorithm_id=algo_id,
-               size=len(signature),
-               signature=signature,
-               )
-
-    # This will be fixed up later
-    filesize = 0
+    # Signature block; the filesize will be fixed up later
     sigs_offset = dest_fileobj.tell()
-    sigs = sigs_header.build(dict(
-        filesize=filesize,
-        count=1,
-        sigs=[sig],
-    ))
-    dest_fileobj.write(sigs)
+    dest_fileobj.write(_single_sig_header_fields.pack(0, 1, algo_id, len(signature)))
+    dest_fileobj.write(signature)
 
     # Write the additional section
     dest_fileobj.write(extras_header.build(mardata.additional))
@@ -374,7 +612,7 @@ def add_signature_block(src_fileobj, dest_fileobj, signing_algorithm, signature=
     # Write the data
     data_offset = dest_fileobj.tell()
     src_fileobj.seek(mardata.data_offset)
-    write_to_file(takeexactly(src_fileobj, mardata.data_length), dest_fileobj)
+    sendfile(src_fileobj, dest_fileobj, mardata.data_length)
 
     # Write the index
     index_offset = dest_fileobj.tell()
@@ -392,13 +630,7 @@ def add_signature_block(src_fileobj, dest_fileobj, signing_algorithm, signature=
 
     # Go back and update the index offset and filesize
     dest_fileobj.seek(0)
-    header.index_offset = index_offset
-    dest_fileobj.write(mar_header.build(header))
-
+    dest_fileobj.write(_mar_header_fields.pack(_MAR_MAGIC, index_offset))
+    # The filesize is the first field of the signatures header
     dest_fileobj.seek(sigs_offset)
-    sigs = sigs_header.build(dict(
-        filesize=filesize,
-        count=1,
-        sigs=[sig],
-    ))
-    dest_fileobj.write(sigs)
+    dest_fileobj.write(_filesize_field.pack(filesize))
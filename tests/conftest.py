@@ -49,13 +49,13 @@ def mar_uu(tmpdir_factory):
 
 
 @pytest.fixture(scope='session')
-def mar_sha384(tmpdir_factory):
+def mar_sha384(tmpdir_factory, test_keys):
     """MAR signed with SHA384"""
     tmpdir = tmpdir_factory.mktemp('data')
     message_p = tmpdir.join('message.txt')
     message_p.write('hello world')
     mar_p = tmpdir.join('test_sha384.mar')
-    private_key, public_key = make_rsa_keypair(4096)
+    private_key, public_key = test_keys[4096]
     with mar_p.open('w+b') as f:
         with MarWriter(f, signing_key=private_key, channel='release',
                        productversion='99.9', signing_algorithm='sha384') as m:
@@ -64,9 +64,16 @@ def mar_sha384(tmpdir_factory):
     return mar_p
 
 
+class _TestKeys(dict):
+    """(private, public) keypairs by key size, generated on first use."""
+
+    def __missing__(self, bits):
+        keys = self[bits] = make_rsa_keypair(bits)
+        return keys
+
+
 @pytest.fixture(scope='session')
 def test_keys():
-    return {
-        2048: make_rsa_keypair(2048),
-        4096: make_rsa_keypair(4096),
-    }
+    # Generating RSA keys is slow, so they're shared by all the tests, and
+    # only generated for the key sizes the selected tests use
+    return _TestKeys()
@@ -10,7 +10,6 @@ from pytest import raises
 from mardor import cli
 from mardor import mozilla
 from mardor.reader import MarReader
-from mardor.signing import make_rsa_keypair
 from mardor.signing import sign_hash
 from mardor.writer import add_signature_block
 
@@ -162,8 +161,8 @@ def test_main_create_signed_v1(tmpdir, key_size, test_keys):
         cli.main(['-v', 'test.mar', '-k', 'key.pem'])
 
 
-def test_main_create_signed_badkeysize(tmpdir):
-    priv, pub = make_rsa_keypair(1024)
+def test_main_create_signed_badkeysize(tmpdir, test_keys):
+    priv, pub = test_keys[1024]
     tmpdir.join('hello.txt').write('hello world')
     tmpdir.join('key.pem').write(priv)
     with tmpdir.as_cwd():
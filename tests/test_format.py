@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import hypothesis.strategies as st
+import pytest
+from construct import GreedyRange
+from construct import StreamError
+from hypothesis import given
+
+from mardor.format import FastCString
+from mardor.format import _compiled
+from mardor.format import IndexEntries
+from mardor.format import IndexEntry
+from mardor.format import index_entry
+
+ascii_text = st.text(st.characters(min_codepoint=1, max_codepoint=127))
+uint32 = st.integers(min_value=0, max_value=2**32 - 1)
+entries = st.lists(st.fixed_dictionaries(dict(
+    offset=uint32, size=uint32, flags=uint32, name=ascii_text)))
+
+
+@given(ascii_text, st.binary())
+def test_cstring(s, trailer):
+    c = FastCString('ascii')
+    data = c.build(s)
+    assert data == s.encode('ascii') + b'\x00'
+    assert c.parse(data + trailer) == s
+
+
+def test_cstring_unterminated():
+    with pytest.raises(StreamError):
+        FastCString('ascii').parse(b'hello' * 100)
+
+
+@given(entries, st.binary(max_size=12))
+def test_index_entries(e, trailer):
+    data = IndexEntries().build(e)
+    assert data == GreedyRange(index_entry).build(e)
+    assert IndexEntries().parse(data) == e
+    assert IndexEntries().parse(data + trailer) == GreedyRange(index_entry).parse(data + trailer)
+
+
+@given(entries)
+def test_index_entries_slotted(e):
+    slotted = [IndexEntry(**d) for d in e]
+    assert IndexEntries().build(slotted) == IndexEntries().build(e)
+
+
+def test_index_entry():
+    e = IndexEntry(offset=1, size=2, flags=3, name='hello')
+    assert (e['offset'], e['size'], e['flags'], e['name']) == (1, 2, 3, 'hello')
+    with pytest.raises(KeyError):
+        e['foo']
+    with pytest.raises(AttributeError):
+        e.foo = 1
+    assert repr(e) == "IndexEntry(offset=1, size=2, flags=3, name='hello')"
+
+
+def test_index_entries_badname():
+    data = IndexEntries().build([dict(offset=1, size=2, flags=3, name='hello')])
+    data += data[:12] + b'\xff\x00'
+    assert len(IndexEntries().parse(data)) == 1
+
+
+def test_compiled():
+    compiled = _compiled(index_entry)
+    assert compiled is not index_entry
+    data = index_entry.build(dict(offset=1, size=2, flags=3, name='foo'))
+    assert compiled.parse(data) == index_entry.parse(data)
+
+
+class _Uncompilable(object):
+    def __init__(self, error):
+        self.error = error
+
+    def compile(self):
+        raise self.error
+
+
+def test_compiled_fallback():
+    # Older versions of construct have no compile method at all
+    old = object()
+    assert _compiled(old) is old
+    subcon = _Uncompilable(NotImplementedError())
+    assert _compiled(subcon) is subcon
+
+
+def test_compiled_error():
+    # Real problems with the structure definitions aren't hidden
+    with pytest.raises(KeyError):
+        _compiled(_Uncompilable(KeyError('oops')))
@@ -2,21 +2,20 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import bz2
+import gzip
+import io
+import lzma
 import os
 import struct
 
 import pytest
-import six
+from mock import patch
 
 from mardor.reader import MarReader
 from mardor.signing import get_publickey
 from mardor.signing import make_hasher
 from mardor.signing import verify_signature
-
-if six.PY2:
-    from backports import lzma
-else:
-    import lzma
+from mardor.writer import MarWriter
 
 TEST_MAR_BZ2 = os.path.join(os.path.dirname(__file__), 'test-bz2.mar')
 TEST_MAR_XZ = os.path.join(os.path.dirname(__file__), 'test-xz.mar')
@@ -48,6 +47,45 @@ def test_verify():
         assert m.verify(pubkey)
 
 
+def test_verify_hashes():
+    with open(TEST_PUBKEY, 'rb') as f:
+        pubkey = f.read()
+    with open(TEST_MAR_BZ2, 'rb') as f, MarReader(f) as m:
+        hashes = m.calculate_hashes()
+        assert m.verify(pubkey, hashes)
+        assert not m.verify(pubkey, [(1, b'\x00' * 20)])
+
+
+def test_verify_hashes_empty():
+    with open(TEST_PUBKEY, 'rb') as f:
+        pubkey = f.read()
+    with open(TEST_MAR_BZ2, 'rb') as f, MarReader(f) as m:
+        assert not m.verify(pubkey, [])
+        assert not m.verify(b'not a key', [])
+
+
+def test_verify_hashes_short():
+    with open(TEST_PUBKEY, 'rb') as f:
+        pubkey = f.read()
+    with open(TEST_MAR_BZ2, 'rb') as f, MarReader(f) as m:
+        hashes = m.calculate_hashes()
+        # A second copy of the signature has no hash to check it against
+        sigs = m.mardata.signatures.sigs
+        sigs.append(sigs[0])
+        assert not m.verify(pubkey, hashes)
+        assert m.verify(pubkey, hashes * 2)
+
+
+def test_verify_hashes_wrong_algorithm():
+    with open(TEST_PUBKEY, 'rb') as f:
+        pubkey = f.read()
+    with open(TEST_MAR_BZ2, 'rb') as f, MarReader(f) as m:
+        [(algo_id, h)] = m.calculate_hashes()
+        assert algo_id == 1
+        assert not m.verify(pubkey, [(2, h)])
+        assert not m.verify(pubkey, [(1, h), (1, h)])
+
+
 def test_verify_nosig(mar_cu):
     with open(TEST_PUBKEY, 'rb') as f:
         pubkey = f.read()
@@ -100,6 +138,32 @@ def test_extract_bz2(tmpdir):
                 b'pref("app.update.channel", "release");\n')
 
 
+@pytest.mark.parametrize('workers', [1, 4])
+def test_extract_workers(tmpdir, workers):
+    with open(TEST_MAR_XZ, 'rb') as f, MarReader(f) as m:
+        m.extract(str(tmpdir), workers=workers)
+        for e in m.mardata.index.entries:
+            expected = b''.join(m.extract_entry(e))
+            assert tmpdir.join(e.name).read('rb') == expected
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_extract_duplicate_names(tmpdir, workers):
+    mar_p = tmpdir.join('test.mar')
+    with mar_p.open('w+b') as f:
+        with MarWriter(f) as m:
+            for i in range(20):
+                name = 'message.txt' if i % 2 else 'other{}.txt'.format(i)
+                m.add_fileobj(io.BytesIO(b"message %d" % i), name, 'bz2', 0o644)
+
+    destdir = tmpdir.join('out')
+    with mar_p.open('rb') as f, MarReader(f) as m:
+        m.extract(str(destdir), workers=workers)
+    # The last entry with the name wins
+    assert destdir.join('message.txt').read('rb') == b'message 19'
+    assert destdir.join('other18.txt').read('rb') == b'message 18'
+
+
 def test_extract_nodecompress(tmpdir):
     with open(TEST_MAR_BZ2, 'rb') as f, MarReader(f) as m:
         m.extract(str(tmpdir), decompress=None)
@@ -124,6 +188,24 @@ def test_extract_badpath(tmpdir):
         e.name = "../" + e.name
         with pytest.raises(ValueError):
             m.extract(str(tmpdir))
+        # Nothing should have been written
+        assert tmpdir.listdir() == []
+
+
+def test_extract_curdir(tmpdir):
+    with open(TEST_MAR_BZ2, 'rb') as f, MarReader(f) as m, tmpdir.as_cwd():
+        m.extract(os.curdir)
+        for e in m.mardata.index.entries:
+            assert tmpdir.join(e.name).check()
+
+
+def test_extract_curdir_badpath(tmpdir):
+    with open(TEST_MAR_BZ2, 'rb') as f, MarReader(f) as m, tmpdir.as_cwd():
+        e = m.mardata.index.entries[0]
+        e.name = "../" + e.name
+        with pytest.raises(ValueError):
+            m.extract(os.curdir)
+        assert tmpdir.listdir() == []
 
 
 def test_extract_xz(tmpdir):
@@ -141,6 +223,17 @@ def test_extract_xz(tmpdir):
                 b'pref("app.update.channel", "release");\n')
 
 
+@pytest.mark.parametrize('marfile, decompress', [
+    (TEST_MAR_BZ2, 'bz2'),
+    (TEST_MAR_XZ, 'xz'),
+])
+def test_extract_explicit_decompression(tmpdir, marfile, decompress):
+    with open(marfile, 'rb') as f, MarReader(f) as m:
+        m.extract(str(tmpdir), decompress=decompress)
+        assert (tmpdir.join('defaults/pref/channel-prefs.js').read('rb') ==
+                b'pref("app.update.channel", "release");\n')
+
+
 def test_extract_baddecompression(tmpdir):
     with open(TEST_MAR_BZ2, 'rb') as f, MarReader(f) as m:
         with pytest.raises(ValueError):
@@ -155,6 +248,12 @@ def test_compression_type_xz():
     with open(TEST_MAR_XZ, 'rb') as f, MarReader(f) as m:
         assert m.compression_type == 'xz'
 
+def test_compression_type_bytesio():
+    with open(TEST_MAR_XZ, 'rb') as f:
+        data = io.BytesIO(f.read())
+    with MarReader(data) as m:
+        assert m.compression_type == 'xz'
+
 def test_compression_type_none(mar_uu):
     with mar_uu.open('rb') as f, MarReader(f) as m:
         assert m.compression_type is None
@@ -188,6 +287,19 @@ def test_calculate_hashes():
         assert verify_signature(pubkey, m.mardata.signatures.sigs[0].signature, hashes[0][1], 'sha1')
 
 
+def test_calculate_hashes_mapped_once():
+    with open(TEST_MAR_BZ2, 'rb') as f, MarReader(f) as m:
+        expected = m.calculate_hashes()
+        with patch('mardor.signing.map_file', side_effect=AssertionError):
+            assert m.calculate_hashes() == expected
+
+
+def test_calculate_hashes_per_signature(mar_sha384):
+    with mar_sha384.open('rb') as f, MarReader(f) as m:
+        hashes = m.calculate_hashes()
+        assert [algo_id for (algo_id, _) in hashes] == [s.algorithm_id for s in m.mardata.signatures.sigs]
+
+
 def test_calculate_hashes_no_sig(mar_cu):
     with mar_cu.open('rb') as f, MarReader(f) as m:
         assert m.calculate_hashes() == []
@@ -294,3 +406,51 @@ def test_productinfo():
 def test_no_productinfo(mar_cu):
     with mar_cu.open('rb') as f, MarReader(f) as m:
         assert m.productinfo is None
+
+
+def test_reader_bytesio(tmpdir):
+    with open(TEST_PUBKEY, 'rb') as f:
+        pubkey = f.read()
+    with open(TEST_MAR_BZ2, 'rb') as f:
+        data = io.BytesIO(f.read())
+    with MarReader(data) as m:
+        assert m.verify(pubkey)
+        m.extract(str(tmpdir))
+    assert (tmpdir.join('defaults/pref/channel-prefs.js').read('rb') ==
+            b'pref("app.update.channel", "release");\n')
+
+
+def test_extract_entry_after_close():
+    with open(TEST_MAR_BZ2, 'rb') as f:
+        with MarReader(f) as m:
+            e = m.mardata.index.entries[1]
+            blocks = list(m.extract_entry(e, decompress='bz2'))
+            raw = list(m.extract_entry(e, decompress=None))
+        # Blocks are still usable after the reader is closed
+        assert b''.join(blocks) == b'pref("app.update.channel", "release");\n'
+        assert b''.join(raw).startswith(b'BZh')
+
+
+@pytest.mark.parametrize('decompress', [None, 'auto'])
+def test_extract_entry_bytes(mar_uu, decompress):
+    # Uncompressed entries are passed through from the memory map as well
+    for marfile in (TEST_MAR_BZ2, str(mar_uu)):
+        with open(marfile, 'rb') as f, MarReader(f) as m:
+            for e in m.mardata.index.entries:
+                for block in m.extract_entry(e, decompress=decompress):
+                    assert type(block) is bytes
+
+
+def test_reader_gzip(tmpdir):
+    # GzipFile has a fileno(), but for the compressed file; it must be read
+    # through, rather than mapped
+    marfile = tmpdir.join('test.mar.gz')
+    with open(TEST_MAR_BZ2, 'rb') as f, gzip.open(str(marfile), 'wb') as g:
+        g.write(f.read())
+    with open(TEST_PUBKEY, 'rb') as f:
+        pubkey = f.read()
+    with gzip.open(str(marfile), 'rb') as f, MarReader(f) as m:
+        assert m.verify(pubkey)
+        m.extract(str(tmpdir.join('out')))
+    assert (tmpdir.join('out', 'defaults/pref/channel-prefs.js').read('rb') ==
+            b'pref("app.update.channel", "release");\n')
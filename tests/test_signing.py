@@ -2,15 +2,27 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
+from io import BytesIO
+import os
+import struct
+
 import pytest
+from mock import patch
 from pytest import raises
 
+from mardor.format import mar
+from mardor.format import sigs_header
+from mardor.signing import _sig_entry_fields
+from mardor.signing import _sigs_header_fields
 from mardor.signing import format_hash
 from mardor.signing import get_privatekey
 from mardor.signing import get_publickey
+from mardor.signing import hash_blocks
 from mardor.signing import make_hasher
 from mardor.signing import make_dummy_signature
 from mardor.signing import make_rsa_keypair
+from mardor.signing import read_signatures_header
 from mardor.signing import sign_hash
 from mardor.signing import verify_signature
 from mardor.signing import get_signature_data
@@ -30,18 +42,121 @@ def test_sign_hash(test_keys):
     assert not verify_signature(pub, sig, b"2" * 20, 'sha1')
 
 
+@pytest.mark.parametrize('key_size, algo_id, hash_algo', [
+    (2048, 1, 'sha1'),
+    (4096, 2, 'sha384'),
+])
+def test_sign_hashlib_digest(test_keys, key_size, algo_id, hash_algo):
+    priv, pub = test_keys[key_size]
+    data = memoryview(b'hello world' * 1000)
+    h = make_hasher(algo_id)
+    for i in range(0, len(data), 4096):
+        h.update(data[i:i + 4096])
+    assert h.name == hash_algo
+
+    sig = sign_hash(priv, h.digest(), h.name)
+    assert verify_signature(pub, sig, getattr(hashlib, hash_algo)(data).digest(), hash_algo)
+
+
+def test_verify_signature_cached_key(test_keys):
+    priv, pub = test_keys[2048]
+    hsh = b"1" * 20
+    sig = sign_hash(priv, hsh, 'sha1')
+
+    assert verify_signature(pub, sig, hsh, 'sha1')
+    # The public key has already been parsed, so it shouldn't be loaded again
+    with patch('mardor.signing.serialization.load_pem_public_key') as load:
+        assert verify_signature(pub, sig, hsh, 'sha1')
+    assert not load.called
+
+
+def test_sign_hash_bytearray_keys(test_keys):
+    priv, pub = test_keys[2048]
+    hsh = b"1" * 20
+    sig = sign_hash(bytearray(priv), hsh, 'sha1')
+    assert verify_signature(memoryview(pub), sig, hsh, 'sha1')
+
+
+def test_sign_hash_cached_key(test_keys):
+    priv, pub = test_keys[2048]
+    hsh = b"1" * 20
+    sig = sign_hash(priv, hsh, 'sha1')
+    with patch('mardor.signing.serialization.load_pem_private_key') as load:
+        assert sign_hash(priv, hsh, 'sha1') == sig
+    assert not load.called
+
+
 def test_get_signature_data(mar_uu):
     with mar_uu.open('rb') as f:
         with raises(IOError):
             list(get_signature_data(f, mar_uu.size))
 
 
+def test_get_signature_data_preamble():
+    marfile = os.path.join(os.path.dirname(__file__), 'test-bz2.mar')
+    size = os.path.getsize(marfile)
+    with open(marfile, 'rb') as f:
+        header = f.read(8)
+        blocks = list(get_signature_data(f, size))
+    assert blocks[0] == header + struct.pack('>QIII', size, 1, 1, 256)
+
+
+def test_get_signature_data_view():
+    marfile = os.path.join(os.path.dirname(__file__), 'test-bz2.mar')
+    size = os.path.getsize(marfile)
+    with open(marfile, 'rb') as f:
+        expected = b''.join(get_signature_data(f, size))
+        f.seek(0)
+        view = memoryview(f.read())
+        # An existing view is used as is, rather than mapping the file again
+        with patch('mardor.signing.map_file', side_effect=AssertionError):
+            blocks = list(get_signature_data(f, size, view=view))
+    assert blocks[1].obj is view.obj
+    assert b''.join(blocks) == expected
+
+
+class _Reader(object):
+    """A file-like object that can't be mapped or viewed in place."""
+
+    def __init__(self, data):
+        self.f = BytesIO(data)
+        self.read = self.f.read
+        self.seek = self.f.seek
+
+
+def test_get_signature_data_unmapped():
+    marfile = os.path.join(os.path.dirname(__file__), 'test-bz2.mar')
+    size = os.path.getsize(marfile)
+    with open(marfile, 'rb') as f:
+        mapped = b''.join(get_signature_data(f, size))
+        f.seek(0)
+        data = f.read()
+    unmapped = list(get_signature_data(_Reader(data), size, block_size=100))
+    assert len(unmapped) > 2
+    assert b''.join(unmapped) == mapped
+
+    # BytesIO data is viewed in place, rather than being read
+    blocks = list(get_signature_data(BytesIO(data), size))
+    assert len(blocks) == 2
+    assert isinstance(blocks[1], memoryview)
+    assert b''.join(blocks) == mapped
+
+
+def test_signature_data_fields_match_format():
+    sig = dict(algorithm_id=2, size=4, signature=b'\x00' * 4)
+    data = sigs_header.build(dict(filesize=12345, count=1, sigs=[sig]))
+    assert data[:12] == _sigs_header_fields.pack(12345, 1)
+    assert data[12:20] == _sig_entry_fields.pack(2, 4)
+
+
 @pytest.mark.parametrize("algo_id, size", [
     (1, 256),
     (2, 512),])
 def test_dummy_sigs(algo_id, size):
     s = make_dummy_signature(algo_id)
     assert len(s) == size
+    assert s == b'\x00' * size
+    assert make_dummy_signature(algo_id) is s
 
 
 def test_dummy_dig_bad_algo():
@@ -50,7 +165,58 @@ def test_dummy_dig_bad_algo():
 
 
 def test_format_hash():
-    h = make_hasher(1).finalize()
+    h = make_hasher(1).digest()
     h = format_hash(h, 'sha1')
 
     assert h
+
+
+@pytest.mark.parametrize("algo_ids", [
+    (),
+    (1,),
+    (1, 2),
+    (2, 1, 2),])
+def test_hash_blocks(algo_ids):
+    blocks = [b'hello', b'world' * 10000] * 10
+    hashers = [make_hasher(algo_id) for algo_id in algo_ids]
+    hash_blocks(hashers, iter(blocks))
+    for h in hashers:
+        assert h.digest() == hashlib.new(h.name, b''.join(blocks)).digest()
+
+
+class _BrokenHasher(object):
+    def update(self, block):
+        raise RuntimeError('broken')
+
+
+@pytest.mark.parametrize('broken', [0, 1, 2])
+def test_hash_blocks_error(broken):
+    hashers = [make_hasher(1), make_hasher(2), make_hasher(1)]
+    hashers[broken] = _BrokenHasher()
+    with raises(RuntimeError):
+        hash_blocks(hashers, iter([b'hello'] * 100))
+
+
+@pytest.mark.parametrize('marfile', ['test-bz2.mar', 'test-xz.mar'])
+def test_read_signatures_header(marfile):
+    marfile = os.path.join(os.path.dirname(__file__), marfile)
+    with open(marfile, 'rb') as f:
+        expected = mar.parse_stream(f).signatures
+        signatures = read_signatures_header(f)
+    assert signatures.filesize == expected.filesize
+    assert signatures.count == expected.count
+    assert signatures.offset_end == expected.offset_end
+    assert [(s.algorithm_id, s.size) for s in signatures.sigs] == \
+        [(s.algorithm_id, s.size) for s in expected.sigs]
+
+
+def test_read_signatures_header_nosigs(mar_uu):
+    with mar_uu.open('rb') as f:
+        assert read_signatures_header(f) is None
+
+
+def test_read_signatures_header_bad():
+    with raises(IOError):
+        read_signatures_header(BytesIO(b'MAR0\x00\x00\x00\x08'))
+    with raises(IOError):
+        read_signatures_header(BytesIO(b'MAR1\x00\x00'))
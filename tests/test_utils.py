@@ -1,21 +1,50 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+from io import BytesIO
 from itertools import repeat
+import bz2
+import errno
+import gzip
+import lzma
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import hypothesis.strategies as st
 import pytest
 from hypothesis import assume
 from hypothesis import given
+from mock import patch
 
+from mardor.utils import _join_curdir
+from mardor.utils import advise_sequential
 from mardor.utils import auto_decompress_stream
 from mardor.utils import bz2_compress_stream
 from mardor.utils import bz2_decompress_stream
+from mardor.utils import file_iter
 from mardor.utils import filesize
+from mardor.utils import guess_compression
+from mardor.utils import make_safejoin
+from mardor.utils import map_file
 from mardor.utils import mkdir
+from mardor.utils import path_is_inside
+from mardor.utils import preallocate
+from mardor.utils import prefetch
+from mardor.utils import pwrite
+from mardor.utils import readinto_iter
+from mardor.utils import real_fileno
+from mardor.utils import rechunk
+from mardor.utils import run_threaded
 from mardor.utils import safejoin
+from mardor.utils import sendfile
 from mardor.utils import takeexactly
+from mardor.utils import threaded_imap
+from mardor.utils import view_iter
+from mardor.utils import xz_compress_stream
+from mardor.utils import xz_decompress_stream
+from mardor.utils import write_to_fd
 
 
 @given(st.lists(st.binary()))
@@ -32,6 +61,13 @@ def test_takeexactly_notenough(data):
         b''.join(takeexactly(data, n+1))
 
 
+def test_takeexactly_lazy():
+    blocks = iter([b'hello', b' world', b'!'])
+    assert [bytes(b) for b in takeexactly(blocks, 8)] == [b'hello', b' wo']
+    # The last block wasn't read
+    assert next(blocks) == b'!'
+
+
 @given(st.lists(st.binary()), st.integers(min_value=1, max_value=9))
 def test_bz2_streams(data, level):
     stream = bz2_decompress_stream(bz2_compress_stream(data, level))
@@ -53,6 +89,27 @@ def test_bz2_stream_exact_blocksize():
     assert b''.join(stream) == b'0' * 100000
 
 
+@pytest.mark.parametrize('workers', [2, 4])
+def test_bz2_stream_workers(workers):
+    data = os.urandom(50000) * 10
+    blocks = [data[i:i + 30000] for i in range(0, len(data), 30000)]
+    compressed = b''.join(bz2_compress_stream(blocks, level=1, workers=workers))
+    # This is several streams one after the other
+    assert compressed.count(b'BZh1') >= 5
+    assert bz2.decompress(compressed) == data
+    # Split the stream up at awkward places to make sure that stream
+    # boundaries are handled within and between blocks
+    for size in (1, 7, 100000):
+        stream = [compressed[i:i + size] for i in range(0, len(compressed), size)]
+        assert b''.join(bz2_decompress_stream(stream)) == data
+
+
+def test_bz2_stream_workers_small():
+    assert (b''.join(bz2_compress_stream([b'hello'], workers=4)) ==
+            b''.join(bz2_compress_stream([b'hello'])))
+    assert b''.join(bz2_decompress_stream(bz2_compress_stream([], workers=4))) == b''
+
+
 def test_auto_decompress():
     n = 10000
     stream = repeat(b'hello', n)
@@ -65,6 +122,26 @@ def test_auto_decompress():
     assert b''.join(stream) == b'hello' * n
 
 
+def test_auto_decompress_xz():
+    stream = auto_decompress_stream(xz_compress_stream(repeat(b'hello', 10000)))
+    assert b''.join(stream) == b'hello' * 10000
+
+
+@pytest.mark.parametrize('wrap', [bytes, bytearray, memoryview])
+def test_guess_compression(wrap):
+    assert guess_compression(wrap(bz2.compress(b'hello'))) == 'bz2'
+    assert guess_compression(wrap(lzma.compress(b'hello'))) == 'xz'
+    assert guess_compression(wrap(b'hello')) is None
+    assert guess_compression(wrap(b'')) is None
+
+
+def test_xz_decompress_multistream():
+    data = lzma.compress(b'hello') + lzma.compress(b' world')
+    for size in (1, 7, len(data)):
+        stream = [data[i:i + size] for i in range(0, len(data), size)]
+        assert b''.join(xz_decompress_stream(stream)) == b'hello world'
+
+
 def test_mkdir(tmpdir):
     d = tmpdir.join('foo')
     mkdir(str(d))
@@ -85,12 +162,409 @@ def test_mkdir_existingfile(tmpdir):
         mkdir(str(d))
 
 
+def test_path_is_inside():
+    assert path_is_inside('/path/to/t', '/path/to/t')
+    assert path_is_inside('/path/to/t/foo', '/path/to/t')
+    assert path_is_inside('/path/to/t/foo', '/path/to/t/')
+    assert path_is_inside('/path/to/t/../t/foo', '/path/to/t')
+    assert path_is_inside('/path', '/')
+    assert not path_is_inside('/path/to/tnew', '/path/to/t')
+    assert not path_is_inside('/path/to', '/path/to/t')
+    assert not path_is_inside('/path/to/t/../tnew', '/path/to/t')
+
+
 def test_safejoin():
     assert safejoin('/path/to/t', 'tnew/foo/bar') == '/path/to/t/tnew/foo/bar'
     with pytest.raises(ValueError):
         safejoin('/path/to/t', '../tnew/foo/bar')
 
 
+def test_make_safejoin(tmpdir):
+    with tmpdir.as_cwd():
+        join = make_safejoin('t')
+        assert join('foo', 'bar') == str(tmpdir.join('t', 'foo', 'bar'))
+        assert join('foo/../bar') == str(tmpdir.join('t', 'bar'))
+        with pytest.raises(ValueError):
+            join('../tnew/foo')
+
+
+def test_make_safejoin_curdir(tmpdir):
+    with tmpdir.as_cwd():
+        join = make_safejoin(os.curdir)
+        assert join('foo', 'bar') == str(tmpdir.join('foo', 'bar'))
+        assert safejoin('./', 'foo') == str(tmpdir.join('foo'))
+        with pytest.raises(ValueError):
+            join('../tnew/foo')
+
+
+def test_join_curdir(tmpdir):
+    with tmpdir.as_cwd():
+        # The current directory doesn't need to be looked up
+        with patch('os.getcwd', side_effect=AssertionError):
+            assert _join_curdir('foo', 'bar') == os.path.join('foo', 'bar')
+            assert _join_curdir('foo/../bar') == 'bar'
+            assert _join_curdir('foo', '..') == os.curdir
+            for bad in ('..', '../tnew/foo', 'foo/../../bar', '/etc/passwd'):
+                with pytest.raises(ValueError):
+                    _join_curdir(bad)
+
+
 def test_filesize():
     with open(__file__, 'rb') as f:
         assert os.path.getsize(__file__) == filesize(f)
+        assert f.tell() == 0
+
+
+def test_filesize_buffered(tmpdir):
+    with tmpdir.join('out').open('wb') as f:
+        f.write(b'hello world')
+        assert filesize(f) == 11
+
+
+def test_filesize_gzip(tmpdir):
+    p = tmpdir.join('out.gz')
+    with gzip.open(str(p), 'wb') as f:
+        f.write(b'hello world' * 100)
+    with gzip.open(str(p), 'rb') as f:
+        # The size of the data, not of the underlying compressed file
+        assert filesize(f) == 1100
+        assert f.tell() == 0
+
+
+def test_filesize_nofileno():
+    f = BytesIO(b'hello world')
+    f.seek(5)
+    assert filesize(f) == 11
+    assert f.tell() == 5
+
+
+def test_sendfile(tmpdir):
+    src_p = tmpdir.join('src')
+    src_p.write_binary(b'hello world' * 100000)
+    with src_p.open('rb') as src, tmpdir.join('dst').open('w+b') as dst:
+        dst.write(b'header')
+        src.seek(5)
+        assert sendfile(src, dst) == len(b'hello world' * 100000) - 5
+        assert src.tell() == src_p.size()
+        assert dst.tell() == 6 + src_p.size() - 5
+    assert tmpdir.join('dst').read_binary() == b'header' + src_p.read_binary()[5:]
+
+
+def test_sendfile_nofileno():
+    dst = BytesIO()
+    assert sendfile(BytesIO(b'hello world'), dst) == 11
+    assert dst.getvalue() == b'hello world'
+
+
+def test_sendfile_gzip(tmpdir):
+    data = b'hello world' * 100
+    with gzip.open(str(tmpdir.join('src.gz')), 'wb') as f:
+        f.write(data)
+    # The uncompressed data is copied, not the underlying compressed file
+    with gzip.open(str(tmpdir.join('src.gz')), 'rb') as src, tmpdir.join('dst').open('wb') as dst:
+        assert sendfile(src, dst) == len(data)
+    assert tmpdir.join('dst').read_binary() == data
+
+    # Likewise, data is written through a GzipFile, rather than underneath it
+    with tmpdir.join('dst').open('rb') as src, gzip.open(str(tmpdir.join('dst.gz')), 'wb') as dst:
+        assert sendfile(src, dst) == len(data)
+    with gzip.open(str(tmpdir.join('dst.gz')), 'rb') as f:
+        assert f.read() == data
+
+
+def test_sendfile_size(tmpdir):
+    src_p = tmpdir.join('src')
+    src_p.write_binary(b'hello world')
+    with src_p.open('rb') as src, tmpdir.join('dst').open('wb') as dst:
+        assert sendfile(src, dst, 5) == 5
+        assert src.tell() == 5
+        with pytest.raises(ValueError):
+            sendfile(src, dst, 7)
+    assert tmpdir.join('dst').read_binary() == b'hello'
+
+    dst = BytesIO()
+    assert sendfile(BytesIO(b'hello world'), dst, 5) == 5
+    assert dst.getvalue() == b'hello'
+    with pytest.raises(ValueError):
+        sendfile(BytesIO(b'hello world'), dst, 12)
+
+
+@pytest.mark.skipif(not hasattr(os, 'copy_file_range'), reason='requires os.copy_file_range')
+def test_sendfile_copy_file_range_fallback(tmpdir):
+    src_p = tmpdir.join('src')
+    src_p.write_binary(b'hello world' * 1000)
+    with src_p.open('rb') as src, tmpdir.join('dst').open('w+b') as dst:
+        dst.write(b'header')
+        with patch('mardor.utils.os.copy_file_range', side_effect=OSError(errno.EXDEV, 'cross-device')) as cfr:
+            assert sendfile(src, dst) == src_p.size()
+        assert cfr.called
+        assert dst.tell() == 6 + src_p.size()
+        dst.write(b'trailer')
+    assert tmpdir.join('dst').read_binary() == b'header' + src_p.read_binary() + b'trailer'
+
+
+def test_sendfile_copier_copies_nothing(tmpdir):
+    src_p = tmpdir.join('src')
+    src_p.write_binary(b'hello world' * 1000)
+
+    def copy_nothing(src_fd, dst_fd, src_offset, dst_offset, count):
+        return 0
+
+    with src_p.open('rb') as src, tmpdir.join('dst').open('w+b') as dst:
+        dst.write(b'header')
+        with patch('mardor.utils._kernel_copiers', [copy_nothing]):
+            assert sendfile(src, dst) == src_p.size()
+        assert src.tell() == src_p.size()
+        assert dst.tell() == 6 + src_p.size()
+    assert tmpdir.join('dst').read_binary() == b'header' + src_p.read_binary()
+
+
+def test_sendfile_copier_stops(tmpdir):
+    src_p = tmpdir.join('src')
+    src_p.write_binary(b'hello world' * 1000)
+    calls = []
+
+    def copy_some(src_fd, dst_fd, src_offset, dst_offset, count):
+        calls.append(count)
+        return 0 if len(calls) > 1 else 5
+
+    with src_p.open('rb') as src, tmpdir.join('dst').open('w+b') as dst:
+        with patch('mardor.utils._kernel_copiers', [copy_some]):
+            with pytest.raises(IOError):
+                sendfile(src, dst)
+
+
+def test_pwrite(tmpdir):
+    p = tmpdir.join('out')
+    p.write_binary(b'hello world')
+    with p.open('r+b') as f:
+        f.seek(2)
+        assert pwrite(f.fileno(), b'HELLO', 0) == 5
+        assert pwrite(f.fileno(), memoryview(b'!!'), 11) == 2
+        assert f.tell() == 2
+    assert p.read_binary() == b'HELLO world!!'
+
+
+@pytest.mark.parametrize('batch', [1, 3, 16])
+def test_write_to_fd(tmpdir, batch):
+    blocks = [b'hello', b'', memoryview(b' world'), bytearray(b'!')] * 5
+    p = tmpdir.join('out')
+    with p.open('wb') as f:
+        assert write_to_fd(blocks, f.fileno(), batch) == 60
+    assert p.read_binary() == b'hello world!' * 5
+
+
+def test_preallocate(tmpdir):
+    p = tmpdir.join('out')
+    with p.open('w+b') as f:
+        assert preallocate(f, 100000)
+        assert f.tell() == 0
+    assert p.size() == 100000
+    assert not preallocate(BytesIO(), 100)
+
+
+def test_advise_sequential():
+    with open(__file__, 'rb') as f:
+        advise_sequential(f)
+        assert f.read()
+    # Not a real file; this shouldn't raise
+    advise_sequential(BytesIO(b'hello world'))
+
+
+def test_file_iter():
+    f = BytesIO(b'hello world')
+    assert list(file_iter(f, 4)) == [b'hell', b'o wo', b'rld']
+
+
+def test_readinto_iter():
+    f = BytesIO(b'hello world')
+    assert [bytes(b) for b in readinto_iter(f, 4)] == [b'hell', b'o wo', b'rld']
+
+
+@pytest.mark.parametrize('compress, decompress', [
+    (bz2_compress_stream, bz2_decompress_stream),
+    (xz_compress_stream, xz_decompress_stream),
+])
+def test_compress_readinto_iter(compress, decompress):
+    data = os.urandom(100000) * 3
+    stream = compress(readinto_iter(BytesIO(data), 4096))
+    assert b''.join(decompress(stream)) == data
+
+
+@pytest.mark.parametrize('preset', [None, 0, 9])
+def test_xz_stream_preset(preset):
+    data = b'hello world' * 10000
+    stream = xz_compress_stream([data], preset=preset)
+    assert b''.join(xz_decompress_stream(stream)) == data
+
+
+def test_readinto_iter_noreadinto():
+    class Reader(object):
+        def __init__(self, data):
+            self.f = BytesIO(data)
+
+        def read(self, n):
+            return self.f.read(n)
+
+    f = Reader(b'hello world')
+    assert list(readinto_iter(f, 4)) == [b'hell', b'o wo', b'rld']
+
+
+@pytest.mark.parametrize('depth', [1, 4])
+def test_prefetch(depth):
+    assert list(prefetch(iter(range(100)), depth)) == list(range(100))
+
+
+def test_prefetch_error():
+    def gen():
+        yield 1
+        raise IOError('oops')
+
+    stream = prefetch(gen())
+    assert next(stream) == 1
+    with pytest.raises(IOError):
+        next(stream)
+
+
+def test_prefetch_close():
+    consumed = []
+
+    def gen():
+        for i in range(100):
+            consumed.append(i)
+            yield i
+
+    stream = prefetch(gen(), 2)
+    assert next(stream) == 0
+    stream.close()
+    # The producer stopped without reading everything from gen()
+    assert len(consumed) < 100
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_run_threaded(workers):
+    results = []
+    run_threaded(results.append, range(100), workers)
+    assert sorted(results) == list(range(100))
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_run_threaded_error(workers):
+    def func(i):
+        if i == 5:
+            raise IOError('oops')
+
+    with pytest.raises(IOError):
+        run_threaded(func, range(100), workers)
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_threaded_imap(workers):
+    assert list(threaded_imap(lambda x: x * 2, range(100), workers)) == list(range(0, 200, 2))
+
+
+def test_threaded_imap_error():
+    def func(i):
+        if i == 5:
+            raise IOError('oops')
+        return i
+
+    results = threaded_imap(func, range(100), 4)
+    assert [next(results) for _ in range(5)] == list(range(5))
+    with pytest.raises(IOError):
+        next(results)
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_threaded_imap_close():
+    started = []
+    release = threading.Event()
+
+    def func(i):
+        started.append(i)
+        if i:
+            release.wait()
+        return i
+
+    futures = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, *args, **kwargs):
+            f = super().submit(*args, **kwargs)
+            futures.append(f)
+            return f
+
+    with patch('mardor.utils.ThreadPoolExecutor', RecordingExecutor):
+        results = threaded_imap(func, range(100), 2)
+        assert next(results) == 0
+        # Both workers are now blocked on items 1 and 2; item 3 is queued
+        _wait_for(lambda: len(started) == 3)
+        assert len(futures) == 4
+
+        # close() waits for the running calls, so do it in the background
+        closer = threading.Thread(target=results.close)
+        closer.start()
+        try:
+            _wait_for(futures[3].cancelled)
+        finally:
+            release.set()
+            closer.join()
+
+    # Nothing else was submitted or started after closing
+    assert len(futures) == 4
+    assert sorted(started) == [0, 1, 2]
+    assert [f.result() for f in futures[:3]] == [0, 1, 2]
+
+
+def test_rechunk():
+    assert list(rechunk([b'hel', b'lo', b' world'], 4)) == [b'hell', b'o wo', b'rld']
+    assert list(rechunk([b'hell', b'o wo'], 4)) == [b'hell', b'o wo']
+    assert list(rechunk([], 4)) == [b'']
+
+
+def test_real_fileno(tmpdir):
+    p = tmpdir.join('data')
+    p.write_binary(b'hello world')
+    for mode, buffering in [('rb', -1), ('rb', 0), ('r+b', -1), ('wb', -1)]:
+        with open(str(p), mode, buffering=buffering) as f:
+            assert real_fileno(f) == f.fileno()
+    assert real_fileno(BytesIO(b'hello world')) is None
+
+    with gzip.open(str(tmpdir.join('data.gz')), 'wb') as f:
+        # GzipFile has a fileno(), but it's for the compressed file
+        assert f.fileno() is not None
+        assert real_fileno(f) is None
+
+    f = open(str(p), 'rb')
+    f.close()
+    assert real_fileno(f) is None
+
+
+def test_map_file_gzip(tmpdir):
+    p = tmpdir.join('data.gz')
+    with gzip.open(str(p), 'wb') as f:
+        f.write(b'hello world')
+    with gzip.open(str(p), 'rb') as f:
+        assert map_file(f) is None
+
+
+def test_map_file(tmpdir):
+    p = tmpdir.join('data')
+    p.write_binary(b'hello world')
+    with p.open('rb') as f:
+        view = map_file(f)
+        assert view == b'hello world'
+        assert [bytes(b) for b in view_iter(view, 2, 4)] == [b'llo ', b'worl', b'd']
+        view.release()
+
+    p.write_binary(b'')
+    with p.open('rb') as f:
+        assert map_file(f) is None
+
+    assert map_file(BytesIO(b'hello world')) is None
@@ -2,16 +2,23 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import bz2
+import gzip
+import os
 
 import pytest
-import six
 from mock import patch
 
 from mardor.format import extras_header
+from mardor.format import mar_header
+from mardor.format import sigs_header
 
 from mardor.reader import MarReader
 from mardor.writer import MarWriter
+from mardor.writer import _MAR_MAGIC
+from mardor.writer import _mar_header_fields
+from mardor.writer import _single_sig_header_fields
 from mardor.writer import add_signature_block
+from mardor.utils import pwrite
 
 from mardor.signing import make_hasher
 from mardor.signing import sign_hash
@@ -64,6 +71,93 @@ def test_writer_adddir(tmpdir):
             assert data == b'hello world'
 
 
+def test_writer_adddir_walk_order(tmpdir):
+    for name in ('a/1.txt', 'a/b/2.txt', 'a/b/c/3.txt', 'a/d/4.txt', 'a/5.txt'):
+        p = tmpdir.join(name)
+        p.dirpath().ensure(dir=True)
+        p.write(name)
+    tmpdir.join('a', 'b', 'c', '3.txt').chmod(0o600)
+    mar_p = tmpdir.join('test.mar')
+    with mar_p.open('wb') as f:
+        with MarWriter(f) as m:
+            with tmpdir.as_cwd():
+                m.add('a')
+                expected = [os.path.join(root, f) for (root, _, files) in os.walk('a') for f in files]
+
+    with mar_p.open('rb') as f:
+        with MarReader(f) as m:
+            entries = m.mardata.index.entries
+    assert [e.name for e in entries] == expected
+    assert {e.name: e.flags for e in entries}['a/b/c/3.txt'] == 0o600
+
+
+def test_writer_adddir_symlinks(tmpdir):
+    tmpdir.join('outside', 'secret.txt').write('secret', ensure=True)
+    tmpdir.join('a', 'message.txt').write('hello world', ensure=True)
+    tmpdir.join('a', 'link').mksymlinkto(tmpdir.join('outside'))
+    mar_p = tmpdir.join('test.mar')
+    with mar_p.open('wb') as f:
+        with MarWriter(f) as m:
+            with tmpdir.as_cwd():
+                m.add('a')
+
+    with mar_p.open('rb') as f:
+        with MarReader(f) as m:
+            assert [e.name for e in m.mardata.index.entries] == ['a/message.txt']
+
+
+@pytest.mark.parametrize('compress', ['bz2', 'xz'])
+def test_writer_adddir_workers(tmpdir, compress):
+    for i in range(20):
+        p = tmpdir.join('a', str(i % 3), '{}.txt'.format(i))
+        p.write_binary(os.urandom(1000) * i, ensure=True)
+        p.chmod(0o600 + i % 2)
+
+    marfiles = []
+    for workers in (1, 4):
+        mar_p = tmpdir.join('test{}.mar'.format(workers))
+        with mar_p.open('w+b') as f:
+            with MarWriter(f) as m:
+                with tmpdir.as_cwd():
+                    m.add('a', compress=compress, workers=workers)
+        marfiles.append(mar_p.read_binary())
+    assert marfiles[0] == marfiles[1]
+
+    with tmpdir.join('test4.mar').open('rb') as f:
+        with MarReader(f) as m:
+            assert len(m.mardata.index.entries) == 20
+            m.extract(str(tmpdir.join('extracted')))
+    for i in range(20):
+        name = os.path.join('a', str(i % 3), '{}.txt'.format(i))
+        assert tmpdir.join('extracted', name).read_binary() == tmpdir.join(name).read_binary()
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_writer_adddir_brokenlink(tmpdir, workers):
+    tmpdir.join('a', 'message.txt').write('hello world', ensure=True)
+    tmpdir.join('a', 'link').mksymlinkto(tmpdir.join('missing'))
+    with tmpdir.join('test.mar').open('w+b') as f:
+        m = MarWriter(f)
+        with pytest.raises(ValueError):
+            with tmpdir.as_cwd():
+                m.add_dir('a', 'bz2', workers=workers)
+
+
+def test_add_fileobj_default_flags(tmpdir):
+    message_p = tmpdir.join('message.txt')
+    message_p.write('hello world')
+    message_p.chmod(0o640)
+    mar_p = tmpdir.join('test.mar')
+    with mar_p.open('wb') as f:
+        with MarWriter(f) as m:
+            with tmpdir.as_cwd(), message_p.open('rb') as src:
+                m.add_fileobj(src, 'message.txt', 'bz2')
+
+    with mar_p.open('rb') as f:
+        with MarReader(f) as m:
+            assert m.mardata.index.entries[0].flags == 0o640
+
+
 def test_writer_uncompressed(tmpdir):
     message_p = tmpdir.join('message.txt')
     message_p.write('hello world')
@@ -110,6 +204,136 @@ def test_writer_compressed(tmpdir):
                     message_compressed)
 
 
+def test_writer_seeks(tmpdir):
+    tmpdir.join('a.txt').write('hello')
+    tmpdir.join('b.txt').write('world')
+    mar_p = tmpdir.join('test.mar')
+    with mar_p.open('w+b') as f:
+        with patch.object(f, 'seek', wraps=f.seek) as seek:
+            with MarWriter(f, productversion='99.9', channel='release') as m:
+                with tmpdir.as_cwd():
+                    m.add('a.txt', compress=None)
+                    m.add('b.txt', compress='bz2')
+                    # Headers are written one after the other, and files are
+                    # appended where the last one ended. The only seeks are
+                    # to the start of the file, and sendfile catching up
+                    # with the kernel's copy.
+                    assert seek.call_count == 2
+                    seek.reset_mock()
+            # Finishing goes back to update the header without seeking
+            assert seek.call_count == 0
+
+    with mar_p.open('rb') as f:
+        with MarReader(f) as m:
+            assert [e.name for e in m.mardata.index.entries] == ['a.txt', 'b.txt']
+            m.extract(str(tmpdir.join('extracted')))
+    assert tmpdir.join('extracted', 'a.txt').read() == 'hello'
+    assert tmpdir.join('extracted', 'b.txt').read() == 'world'
+
+
+def test_writer_unbuffered(tmpdir, test_keys):
+    private_key, public_key = test_keys[2048]
+    tmpdir.join('a', 'message.txt').write('hello world', ensure=True)
+    tmpdir.join('a', 'other.txt').write('hello again', ensure=True)
+    mar_p = tmpdir.join('test.mar')
+    with open(str(mar_p), 'w+b', buffering=0) as f:
+        with MarWriter(f, signing_key=private_key, channel='release',
+                       productversion='99.9', signing_algorithm='sha1') as m:
+            assert m.fileobj is not f
+            with tmpdir.as_cwd():
+                m.add('a', compress='bz2')
+                m.add('a/message.txt', compress=None)
+        # Everything has been flushed through to the caller's file
+        assert f.seek(0, 2) == mar_p.size()
+
+    with mar_p.open('rb') as f:
+        with MarReader(f) as m:
+            assert len(m.mardata.index.entries) == 3
+            assert m.verify(public_key)
+            m.extract(str(tmpdir.join('extracted')))
+    assert tmpdir.join('extracted', 'a', 'other.txt').read() == 'hello again'
+
+    # finish() alone leaves the file complete
+    with open(str(tmpdir.join('test2.mar')), 'wb', buffering=0) as f:
+        m = MarWriter(f)
+        with tmpdir.as_cwd():
+            m.add('a/message.txt')
+        m.finish()
+        assert f.seek(0, 2) == 8 + 11 + 4 + 12 + len('a/message.txt') + 1
+
+
+def test_header_fields_match_format():
+    assert _mar_header_fields.pack(_MAR_MAGIC, 1234) == mar_header.build(dict(index_offset=1234))
+    sig = dict(algorithm_id=2, size=4, signature=b'sig!')
+    data = sigs_header.build(dict(filesize=12345, count=1, sigs=[sig]))
+    assert data == _single_sig_header_fields.pack(12345, 1, 2, 4) + b'sig!'
+
+
+@pytest.mark.parametrize('signatures', [
+    [],
+    [(1, b'\x01' * 256)],
+    [(1, b'\x01' * 256), (2, b'\x02' * 512)],
+])
+def test_build_signatures_matches_format(tmpdir, signatures):
+    with tmpdir.join('test.mar').open('w+b') as f:
+        m = MarWriter(f)
+        m.filesize = 12345
+        data = m._build_signatures(signatures)
+    sigs = [dict(algorithm_id=id_, size=len(sig), signature=sig) for (id_, sig) in signatures]
+    assert data == sigs_header.build(dict(filesize=12345, count=len(sigs), sigs=sigs))
+    assert m.additional_offset == 8 + len(data)
+    assert m._signatures.offset_end == m.additional_offset
+    assert [(s.algorithm_id, s.size) for s in m._signatures.sigs] == [(id_, len(sig)) for (id_, sig) in signatures]
+
+
+@pytest.mark.parametrize('preallocate_size', [100, 1024**2])
+def test_writer_preallocate(tmpdir, test_keys, preallocate_size):
+    private_key, public_key = test_keys[2048]
+    tmpdir.join('message.txt').write('hello world' * 100)
+    mar_p = tmpdir.join('test.mar')
+    with mar_p.open('w+b') as f:
+        with MarWriter(f, signing_key=private_key, channel='release', productversion='99.9',
+                       signing_algorithm='sha1', preallocate_size=preallocate_size) as m:
+            with tmpdir.as_cwd():
+                m.add('message.txt', compress='bz2')
+        assert m.filesize == mar_p.size()
+
+    with mar_p.open('rb') as f:
+        with MarReader(f) as m:
+            assert m.verify(public_key)
+            assert m.mardata.signatures.filesize == mar_p.size()
+
+
+def test_writer_header_placeholder(tmpdir):
+    mar_p = tmpdir.join('test.mar')
+    with mar_p.open('w+b') as f:
+        m = MarWriter(f)
+        m.flush()
+        assert mar_p.read_binary() == b'MAR1\x00\x00\x00\x00'
+        m.finish()
+        m.flush()
+    assert mar_p.read_binary() == b'MAR1\x00\x00\x00\x08\x00\x00\x00\x00'
+
+
+def test_writer_stream_error(tmpdir):
+    def broken():
+        yield b'partial data'
+        raise IOError('oops')
+
+    mar_p = tmpdir.join('test.mar')
+    with mar_p.open('w+b') as f:
+        with MarWriter(f) as m:
+            with pytest.raises(IOError):
+                m.add_stream(broken(), 'broken.txt', None, 0o644)
+            m.add_stream([b'hello world'], 'message.txt', None, 0o644)
+
+    with mar_p.open('rb') as f:
+        with MarReader(f) as m:
+            assert [e.name for e in m.mardata.index.entries] == ['message.txt']
+            e = m.mardata.index.entries[0]
+            assert b''.join(m.extract_entry(e)) == b'hello world'
+
+
 def test_additional(tmpdir):
     message_p = tmpdir.join('message.txt')
     message_p.write('hello world')
@@ -181,6 +405,25 @@ def test_signing(tmpdir, key_size, algo_id, test_keys):
             assert m.verify(public_key)
 
 
+def test_signing_known_layout(tmpdir, test_keys):
+    private_key, public_key = test_keys[2048]
+    message_p = tmpdir.join('message.txt')
+    message_p.write('hello world')
+    mar_p = tmpdir.join('test.mar')
+    with patch('mardor.signing.read_signatures_header') as read_signatures_header:
+        with mar_p.open('w+b') as f:
+            with MarWriter(f, signing_key=private_key, channel='release',
+                           productversion='99.9', signing_algorithm='sha1') as m:
+                with tmpdir.as_cwd():
+                    m.add('message.txt')
+    # The writer knows where it put the signatures
+    assert not read_signatures_header.called
+
+    with mar_p.open('rb') as f:
+        with MarReader(f) as m:
+            assert m.verify(public_key)
+
+
 def test_addfile_as_dir(tmpdir):
     message_p = tmpdir.join('message.txt')
     message_p.write('hello world')
@@ -266,6 +509,7 @@ def test_add_signature(tmpdir, mar_cue, test_keys):
 
         assert len(m.mardata.index.entries) == len(m1.mardata.index.entries)
         assert m1.mardata.signatures.count == 1
+        assert m1.mardata.signatures.filesize == dest_mar.size()
 
         hashes = m1.calculate_hashes()
         assert len(hashes) == 1
@@ -309,8 +553,8 @@ def test_padding(tmpdir):
         extras = extras_header.build(dict(
             count=1,
             sections=[dict(
-                channel=six.u(channel),
-                productversion=six.u(productversion),
+                channel=channel,
+                productversion=productversion,
                 size=len(channel) + len(productversion) + 2 + 8 + 10,
                 padding=b'\x00' * 10,
             )],
@@ -328,3 +572,42 @@ def test_padding(tmpdir):
     with mar_p.open('rb') as f:
         with MarReader(f) as m:
             assert m.mardata.additional.sections[0].padding == b'\x00' * 10
+
+
+@pytest.mark.parametrize('kwargs', [{}, dict(channel='release', productversion='99.9')])
+def test_writer_finish_writes_everything(tmpdir, kwargs):
+    tmpdir.join('message.txt').write('hello world')
+    mar_p = tmpdir.join('test.mar')
+    with mar_p.open('w+b') as f:
+        m = MarWriter(f, **kwargs)
+        with tmpdir.as_cwd():
+            m.add('message.txt')
+        with patch('mardor.writer.pwrite', wraps=pwrite) as pw:
+            m.finish()
+        # The header, and the signatures header after it, are the only
+        # writes that aren't appended to the file. They go out together.
+        assert pw.call_count == 1
+        # The index went out along with the header, without a separate flush
+        assert mar_p.size() == m.filesize
+        with mar_p.open('rb') as g:
+            with MarReader(g) as r:
+                assert [e.name for e in r.mardata.index.entries] == ['message.txt']
+                if kwargs:
+                    assert r.mardata.signatures.filesize == m.filesize
+                    assert r.mardata.signatures.count == 0
+
+
+def test_add_fileobj_gzip(tmpdir):
+    data = b'hello world' * 100
+    with gzip.open(str(tmpdir.join('message.txt.gz')), 'wb') as f:
+        f.write(data)
+    mar_p = tmpdir.join('test.mar')
+    with mar_p.open('w+b') as f:
+        with MarWriter(f) as m:
+            with gzip.open(str(tmpdir.join('message.txt.gz')), 'rb') as src:
+                m.add_fileobj(src, 'message.txt', None, 0o644)
+
+    with mar_p.open('rb') as f, MarReader(f) as m:
+        [e] = m.mardata.index.entries
+        assert e.size == len(data)
+        assert b''.join(m.extract_entry(e, decompress=None)) == data